@@ -4,21 +4,28 @@ Aplicación Streamlit para detección y conteo con YOLOv11
 Autor: Fausto Guano- Universidad Yachay Tech
 """
 
+import json
+import logging
 import os
+import queue
+import shutil
 import tempfile
+import threading
 import time
-from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 
+import numpy as np
 import streamlit as st
 
-from detector import CyclistDetector
+from detector import CyclistDetector, downscale_video, free_gpu_memory, iou_matrix, update_crossings
 from utils import (
     create_comparison_chart,
     create_direction_chart,
     create_flow_gauge,
     create_metrics_dashboard,
-    create_summary_dataframe,
+    create_summary_csv,
     display_technical_details,
+    enrich_metrics,
     generate_recommendations,
 )
 
@@ -50,12 +57,167 @@ st.markdown(
         border-radius: 0.5rem;
         margin: 0.5rem 0;
     }
+    /* Mejorar visualización de videos */
+    video {
+        width: 100% !important;
+        height: auto !important;
+        border-radius: 10px;
+        box-shadow: 0 4px 6px rgba(0, 0, 0, 0.1);
+    }
+    /* Asegurar que los videos mantengan su proporción */
+    [data-testid="stVideo"] {
+        width: 100%;
+    }
     </style>
 """,
     unsafe_allow_html=True,
 )
 
 
+class LogCaptureHandler(logging.Handler):
+    """Handler de logging que acumula los mensajes formateados en una lista"""
+
+    def __init__(self, level=logging.INFO):
+        super().__init__(level)
+        self.lines = []
+        self.setFormatter(logging.Formatter("%(levelname)s:%(name)s:%(message)s"))
+
+    def emit(self, record):
+        self.lines.append(self.format(record))
+
+
+def run_with_progress(func, progress_bar, status_text, min_interval=0.1, **kwargs):
+    """
+    Ejecuta func en un hilo secundario y refresca el progreso desde el hilo principal
+
+    El callback de progreso solo encola (percent, mensaje); el hilo de Streamlit
+    consume la cola y renderiza como máximo una actualización cada min_interval
+    segundos, descartando las intermedias. Si el script se interrumpe (por
+    ejemplo, un rerun de Streamlit), se activa cancel_event para detener func.
+
+    Args:
+        func: Función a ejecutar; recibe progress_callback y cancel_event además de kwargs
+        progress_bar: Barra de progreso de Streamlit
+        status_text: Contenedor de texto para el mensaje de estado
+        min_interval: Segundos mínimos entre renders de progreso
+        **kwargs: Argumentos para func
+
+    Returns:
+        Resultado de func (las excepciones se propagan al hilo principal)
+    """
+    progress_queue = queue.Queue()
+    last_render = 0.0
+    latest = None
+
+    cancel_event = threading.Event()
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        future = executor.submit(
+            func,
+            progress_callback=lambda *update: progress_queue.put(update),
+            cancel_event=cancel_event,
+            **kwargs,
+        )
+
+        try:
+            while not future.done():
+                try:
+                    latest = progress_queue.get(timeout=min_interval)
+                    while True:  # quedarse solo con la actualización más reciente
+                        latest = progress_queue.get_nowait()
+                except queue.Empty:
+                    pass
+
+                if latest is not None and time.time() - last_render >= min_interval:
+                    percent, message = latest
+                    progress_bar.progress(percent)
+                    status_text.text(message)
+                    last_render = time.time()
+                    latest = None
+        finally:
+            if not future.done():
+                cancel_event.set()
+
+        return future.result()
+
+
+@st.cache_resource(show_spinner=False)
+def warm_up_numba():
+    """Compila los kernels de Numba al iniciar, no durante el primer video"""
+    iou_matrix(np.zeros((1, 4), np.float32), np.zeros((1, 4), np.float32))
+    update_crossings(
+        np.zeros(1, np.int64), np.zeros((1, 2), np.int32), np.zeros((1, 2), np.int32),
+        np.zeros(1, bool), np.zeros((4, 1), bool), np.zeros(2, np.int32), np.zeros((1, 3), np.int64),
+    )
+
+
+warm_up_numba()
+
+
+@st.cache_resource(show_spinner=False)
+def get_detector(model_size, detect_persons, backend, precision):
+    """
+    Carga el detector una sola vez y lo reutiliza entre reruns de Streamlit
+
+    Args:
+        model_size: Tamaño del modelo ('n' o 's')
+        detect_persons: Si True, detecta personas además de bicicletas
+        backend: Backend de inferencia ('torch', 'onnx' o 'trt')
+        precision: Precisión numérica ('fp32', 'fp16' o 'int8')
+
+    Returns:
+        Instancia de CyclistDetector con el modelo cargado
+    """
+    return CyclistDetector(
+        model_size=model_size,
+        detect_persons=detect_persons,
+        backend=backend,
+        precision=precision,
+    )
+
+
+@st.cache_data(max_entries=32, show_spinner=False)
+def make_csv(metrics_json):
+    """
+    Genera el CSV de resumen una sola vez por conjunto de métricas
+
+    Args:
+        metrics_json: Métricas serializadas con json.dumps(sort_keys=True)
+
+    Returns:
+        Contenido CSV como string
+    """
+    return create_summary_csv(json.loads(metrics_json))
+
+
+def render_charts(metrics):
+    """
+    Dibuja los gráficos del análisis (dirección, flujo temporal e indicador de flujo)
+
+    Args:
+        metrics: Diccionario con métricas del análisis
+    """
+    # Sin cruces los gráficos quedarían en cero: no se construyen las figuras
+    if metrics["total_cyclists"] == 0:
+        st.info("ℹ️ Sin datos de cruces para graficar")
+        return
+
+    col1, col2 = st.columns(2)
+
+    with col1:
+        fig_direction = create_direction_chart(metrics)
+        st.plotly_chart(fig_direction, use_container_width=True)
+
+    with col2:
+        fig_comparison = create_comparison_chart(metrics)
+        st.plotly_chart(fig_comparison, use_container_width=True)
+
+    # Gauge de flujo
+    st.markdown("### 🎯 Indicador de Flujo")
+    fig_gauge = create_flow_gauge(metrics)
+    st.plotly_chart(fig_gauge, use_container_width=True)
+
+
 def main():
     """Función principal de la aplicación"""
 
@@ -95,6 +257,38 @@ def main():
             help="Nano es más rápido, Small es más preciso",
         )
 
+        # Precisión numérica de inferencia
+        precision = st.radio(
+            "Precisión:",
+            options=["fp32", "fp16", "int8"],
+            index=["fp32", "fp16", "int8"].index(CyclistDetector.default_precision()),
+            format_func=lambda x: {
+                "fp32": "🎯 FP32 (máxima precisión)",
+                "fp16": "⚡ FP16 (GPU, ~2x más rápido)",
+                "int8": "🚀 INT8 (cuantizado, ~2-3x más rápido)",
+            }[x],
+            help="FP16 reduce a la mitad la memoria en GPU. INT8 requiere backend ONNX o TensorRT.",
+        )
+
+        if precision == "int8":
+            st.warning(
+                "⚠️ INT8 pierde precisión de detección (hasta ~7 puntos de mAP con "
+                "cuantización estática en TensorRT). Verifica el conteo con FP32."
+            )
+
+        # Backend de inferencia
+        backend = st.radio(
+            "Backend:",
+            options=["torch", "onnx", "trt"],
+            index=["torch", "onnx", "trt"].index(CyclistDetector.default_backend()),
+            format_func=lambda x: {
+                "torch": "🔥 PyTorch (.pt)",
+                "onnx": "⚡ ONNX-Runtime (CPU)",
+                "trt": "🟩 TensorRT (GPU NVIDIA)",
+            }[x],
+            help="ONNX-Runtime es más rápido en CPU (Streamlit Cloud). TensorRT requiere GPU NVIDIA. El modelo se exporta solo la primera vez.",
+        )
+
         # Umbral de confianza
         confidence = st.slider(
             "Confianza mínima:",
@@ -148,7 +342,34 @@ def main():
             "Procesar cada N frames:",
             options=[1, 2, 3],
             index=0,
-            help="Mayor = más rápido pero menos preciso",
+            help="Mayor = más rápido pero menos preciso. El video procesado muestra solo los frames analizados.",
+        )
+
+        # Resolución a la que se analiza el video
+        analysis_resolution = st.selectbox(
+            "Resolución de análisis:",
+            options=["original", "720p", "480p"],
+            index=1,
+            help="Videos de mayor resolución se reducen antes del análisis. YOLO trabaja a 640 px, así que 720p no pierde precisión y es mucho más rápido que 1080p/4K.",
+        )
+
+        # Tamaño de lote para inferencia
+        batch_size = st.selectbox(
+            "Frames por lote (batch):",
+            options=[None, 1, 2, 4, 8, 16],
+            index=0,
+            format_func=lambda n: f"Auto ({CyclistDetector.DEFAULT_BATCH_SIZE} con GPU, 1 en CPU)" if n is None else str(n),
+            help=(
+                "Procesa varios frames por llamada al modelo. Valores altos aprovechan mejor la GPU pero usan más memoria. "
+                f"Con TensorRT el máximo es {CyclistDetector.DEFAULT_BATCH_SIZE}."
+            ),
+        )
+
+        # Aceleración estimada según precisión y salto de frames
+        precision_speedup = {"fp32": 1.0, "fp16": 2.0, "int8": 2.5}[precision]
+        st.caption(
+            f"⏱️ Aceleración estimada: ~{precision_speedup * process_every_n:.1f}x "
+            f"vs FP32 procesando todos los frames"
         )
 
         # Opción para detectar personas (experimental)
@@ -166,6 +387,18 @@ def main():
                 "⚠️ Detección de personas habilitada. Puede contar peatones como ciclistas."
             )
 
+        hw_encode = st.checkbox(
+            "Acelerar codificación (NVENC)",
+            value=False,
+            help="Codifica el video de salida con la GPU (NVENC o VAAPI). Si no hay encoder por hardware se usa la CPU.",
+        )
+
+        skip_empty_frames = st.checkbox(
+            "Omitir frames sin detecciones",
+            value=False,
+            help="El video de salida solo incluye los frames con ciclistas detectados (más corto y rápido de generar). Las métricas no cambian.",
+        )
+
         st.markdown("---")
 
         # Información del proyecto
@@ -220,7 +453,8 @@ def main():
             # Advertencia para archivos grandes
             if file_size_mb > 50:
                 st.warning(
-                    "⚠️ Archivo grande detectado. El procesamiento puede tomar varios minutos."
+                    "⚠️ Archivo grande detectado. El procesamiento puede tomar varios minutos. "
+                    "Usa 'Resolución de análisis' 720p o 480p para acelerarlo."
                 )
 
             # Botón de procesamiento
@@ -240,6 +474,12 @@ def main():
                     line_orientation,
                     process_every_n,
                     detect_persons,
+                    backend,
+                    precision,
+                    batch_size,
+                    hw_encode,
+                    analysis_resolution,
+                    skip_empty_frames,
                 )
         else:
             # Mostrar instrucciones
@@ -501,6 +741,12 @@ def process_video(
     line_orientation,
     process_every_n,
     detect_persons,
+    backend,
+    precision,
+    batch_size,
+    hw_encode,
+    analysis_resolution,
+    skip_empty_frames,
 ):
     """
     Procesa el video subido y muestra resultados
@@ -514,21 +760,43 @@ def process_video(
         line_orientation: Orientación de línea ('horizontal', 'vertical', 'both')
         process_every_n: Procesar cada N frames
         detect_persons: Si True, detecta personas además de bicicletas
+        backend: Backend de inferencia ('torch', 'onnx' o 'trt')
+        precision: Precisión numérica ('fp32', 'fp16' o 'int8')
+        batch_size: Frames por llamada al modelo (None = automático)
+        hw_encode: Si True, codifica el video de salida por hardware (NVENC/VAAPI)
+        analysis_resolution: Resolución de análisis ('original', '720p' o '480p')
+        skip_empty_frames: Si True, omite del video de salida los frames sin detecciones
     """
 
-    # Guardar archivo temporal
+    # Guardar archivo temporal copiando por bloques de 1MB
+    # (evita materializar todo el video en un único objeto bytes)
+    uploaded_file.seek(0)
     with tempfile.NamedTemporaryFile(delete=False, suffix=".mp4") as tmp_file:
-        tmp_file.write(uploaded_file.read())
-        video_path = tmp_file.name
+        shutil.copyfileobj(uploaded_file, tmp_file, length=1024 * 1024)
+        upload_path = tmp_file.name
+
+    video_path = upload_path
 
     try:
+        # Reducir resolución antes del análisis (si el video la supera)
+        if analysis_resolution != "original":
+            with st.spinner(f"📐 Ajustando resolución de análisis a {analysis_resolution}..."):
+                video_path = downscale_video(upload_path, int(analysis_resolution.rstrip("p")))
+
+        # Si cambia la configuración del modelo, descargar el anterior antes de
+        # cargar el nuevo para no tener ambos en la GPU a la vez. La caché es
+        # compartida entre sesiones: solo se descarta la entrada de esta sesión
+        # (un video en curso conserva su propia referencia al detector)
+        detector_key = (model_size, detect_persons, backend, precision)
+        previous_key = st.session_state.get("detector_key", detector_key)
+        if previous_key != detector_key:
+            get_detector.clear(*previous_key)
+            free_gpu_memory()
+        st.session_state["detector_key"] = detector_key
+
         # Inicializar detector
         with st.spinner(f"🔧 Inicializando YOLOv11{model_size}..."):
-            detector = CyclistDetector(
-                model_size=model_size,
-                conf_threshold=confidence,
-                detect_persons=detect_persons,
-            )
+            detector = get_detector(model_size, detect_persons, backend, precision)
 
         st.success(f"✅ Modelo YOLOv11{model_size} cargado")
 
@@ -542,42 +810,43 @@ def process_video(
             progress_bar = st.progress(0)
             status_text = st.empty()
 
-        # Lista para capturar logs
-        import io
-        import sys
-
-        log_capture = io.StringIO()
-
-        # Función callback para actualizar progreso
-        def update_progress(percent, message):
-            progress_bar.progress(percent)
-            status_text.text(message)
-
         status_text.text("🎬 Procesando video...")
         start_time = time.time()
 
-        # Capturar logs
-        old_stdout = sys.stdout
-        sys.stdout = log_capture
-
-        # Detectar y contar
-        output_path, metrics = detector.detect_and_track(
-            video_path=video_path,
-            line_position=line_position,
-            line_position_x=line_position_x,
-            line_orientation=line_orientation,
-            process_every_n_frames=process_every_n,
-            progress_callback=update_progress,
-        )
+        # Capturar logs del detector y de Ultralytics (sin redirigir stdout)
+        log_handler = LogCaptureHandler()
+        log_targets = [logging.getLogger(), logging.getLogger("ultralytics")]
+        for target in log_targets:
+            target.addHandler(log_handler)
 
-        # Restaurar stdout
-        sys.stdout = old_stdout
+        try:
+            # Detectar y contar (en segundo plano para no bloquear la UI)
+            output_path, metrics = run_with_progress(
+                detector.detect_and_track,
+                progress_bar,
+                status_text,
+                video_path=video_path,
+                line_position=line_position,
+                line_position_x=line_position_x,
+                line_orientation=line_orientation,
+                process_every_n_frames=process_every_n,
+                batch_size=batch_size,
+                hw_encode=hw_encode,
+                skip_empty_frames=skip_empty_frames,
+                # El umbral se pasa por video: el detector es compartido entre sesiones
+                conf_threshold=confidence,
+            )
+        finally:
+            for target in log_targets:
+                target.removeHandler(log_handler)
+
+        # Proporciones por sentido calculadas una sola vez para todos los reportes
+        metrics = enrich_metrics(metrics)
 
         # Mostrar logs capturados
-        log_output = log_capture.getvalue()
-        if log_output:
+        if log_handler.lines:
             with log_container:
-                st.code(log_output, language="log")
+                st.code("\n".join(log_handler.lines), language="log")
 
         progress_bar.progress(100)
         processing_time = time.time() - start_time
@@ -623,130 +892,64 @@ def process_video(
         # Dashboard de métricas
         create_metrics_dashboard(metrics)
 
-        st.markdown("---")
-
         # Videos lado a lado
-        st.markdown("### 🎬 Videos Comparativos")
-
-        # CSS personalizado para mejorar visualización de videos
-        st.markdown(
-            """
-        <style>
-        /* Mejorar visualización de videos */
-        video {
-            width: 100% !important;
-            height: auto !important;
-            border-radius: 10px;
-            box-shadow: 0 4px 6px rgba(0, 0, 0, 0.1);
-        }
-
-        /* Asegurar que los videos mantengan su proporción */
-        [data-testid="stVideo"] {
-            width: 100%;
-        }
-        </style>
-        """,
-            unsafe_allow_html=True,
-        )
-
-        # Obtener propiedades del video original
-        import cv2
+        st.markdown("---\n### 🎬 Videos Comparativos")
 
-        cap_info = cv2.VideoCapture(video_path)
-        video_width = int(cap_info.get(cv2.CAP_PROP_FRAME_WIDTH))
-        video_height = int(cap_info.get(cv2.CAP_PROP_FRAME_HEIGHT))
-        video_fps = int(cap_info.get(cv2.CAP_PROP_FPS))
-        cap_info.release()
+        # Propiedades del video analizado (obtenidas al decodificarlo en el detector)
+        video_width = metrics["video_info"]["width"]
+        video_height = metrics["video_info"]["height"]
+        video_fps = metrics["video_info"]["fps"]
 
         st.info(
-            f"📐 Dimensiones: {video_width}x{video_height} píxeles | 🎞️ FPS: {video_fps}"
+            f"📐 Dimensiones de análisis: {video_width}x{video_height} píxeles | 🎞️ FPS: {video_fps}"
         )
 
-        col1, col2 = st.columns(2)
-
-        with col1:
-            st.markdown("**Video Original**")
-            st.video(video_path)
-            st.caption(f"Resolución: {video_width}x{video_height}")
-
-        with col2:
-            st.markdown("**Video con Detecciones**")
-            if os.path.exists(output_path):
-                # Verificar tamaño del archivo
-                file_size = os.path.getsize(output_path)
-                if file_size > 0:
-                    try:
-                        # Obtener propiedades del video procesado
-                        cap_proc = cv2.VideoCapture(output_path)
-                        proc_width = int(cap_proc.get(cv2.CAP_PROP_FRAME_WIDTH))
-                        proc_height = int(cap_proc.get(cv2.CAP_PROP_FRAME_HEIGHT))
-                        proc_fps = int(cap_proc.get(cv2.CAP_PROP_FPS))
-                        cap_proc.release()
-
-                        # Usar la ruta del archivo directamente para mejor compatibilidad
-                        st.video(output_path)
-                        st.caption(
-                            f"Resolución: {proc_width}x{proc_height} | Tamaño: {file_size / (1024*1024):.2f} MB"
-                        )
-
-                        # Advertencia si las dimensiones no coinciden
-                        if proc_width != video_width or proc_height != video_height:
-                            st.warning(
-                                f"⚠️ Las dimensiones del video procesado ({proc_width}x{proc_height}) no coinciden con el original ({video_width}x{video_height})"
-                            )
-                    except Exception as e:
-                        st.warning(
-                            f"⚠️ No se pudo mostrar el video en el navegador: {e}"
-                        )
-                        st.info(
-                            "📥 Puedes descargar el video procesado más abajo en 'Exportar Resultados'"
-                        )
-                else:
-                    st.error("El video procesado está vacío")
+        # Video procesado a ancho completo; el original queda plegado para
+        # no descargarlo ni decodificarlo en el navegador si no se consulta
+        st.markdown("**Video con Detecciones**")
+        if os.path.exists(output_path):
+            # Verificar tamaño del archivo
+            file_size = os.path.getsize(output_path)
+            if file_size > 0:
+                try:
+                    # Usar la ruta del archivo directamente para mejor compatibilidad
+                    st.video(output_path)
+                    st.caption(
+                        f"Resolución: {video_width}x{video_height} | Tamaño: {file_size / (1024*1024):.2f} MB"
+                    )
+                except Exception as e:
+                    st.warning(
+                        f"⚠️ No se pudo mostrar el video en el navegador: {e}"
+                    )
+                    st.info(
+                        "📥 Puedes descargar el video procesado más abajo en 'Exportar Resultados'"
+                    )
             else:
-                st.error("No se pudo generar el video procesado")
+                st.error("El video procesado está vacío")
+        else:
+            st.error("No se pudo generar el video procesado")
 
-        st.markdown("---")
+        with st.expander("Ver video original", expanded=False):
+            st.video(upload_path)
 
         # Visualizaciones
-        st.markdown("### 📊 Análisis Visual")
+        st.markdown("---\n### 📊 Análisis Visual")
+        render_charts(metrics)
 
-        col1, col2 = st.columns(2)
-
-        with col1:
-            fig_direction = create_direction_chart(metrics)
-            st.plotly_chart(fig_direction, use_container_width=True)
-
-        with col2:
-            fig_comparison = create_comparison_chart(metrics)
-            st.plotly_chart(fig_comparison, use_container_width=True)
-
-        # Gauge de flujo
-        st.markdown("### 🎯 Indicador de Flujo")
-        fig_gauge = create_flow_gauge(metrics)
-        st.plotly_chart(fig_gauge, use_container_width=True)
-
-        st.markdown("---")
-
-        # Recomendaciones
+        # Recomendaciones, entre separadores, en un solo bloque Markdown
         recommendations = generate_recommendations(metrics)
-        st.markdown(recommendations)
-
-        st.markdown("---")
+        st.markdown(f"---\n{recommendations}\n---")
 
         # Detalles técnicos
         display_technical_details(metrics)
 
         # Exportar resultados
-        st.markdown("---")
-        st.markdown("### 💾 Exportar Resultados")
-
-        df_summary = create_summary_dataframe(metrics)
+        st.markdown("---\n### 💾 Exportar Resultados")
 
         col1, col2 = st.columns(2)
 
         with col1:
-            csv = df_summary.to_csv(index=False)
+            csv = make_csv(json.dumps(metrics, sort_keys=True, default=str))
             st.download_button(
                 label="📥 Descargar CSV",
                 data=csv,
@@ -756,6 +959,7 @@ def process_video(
 
         with col2:
             if os.path.exists(output_path):
+                # Streamlit lee el archivo una sola vez al registrar el botón
                 with open(output_path, "rb") as f:
                     st.download_button(
                         label="📥 Descargar Video Procesado",
@@ -771,14 +975,18 @@ def process_video(
     finally:
         # Limpiar archivos temporales
         try:
-            if os.path.exists(video_path):
-                os.unlink(video_path)
+            for temp_path in {upload_path, video_path}:
+                if os.path.exists(temp_path):
+                    os.unlink(temp_path)
             if "output_path" in locals() and os.path.exists(output_path):
                 # No eliminar el output inmediatamente para permitir descarga
                 pass
         except Exception as e:
             st.warning(f"No se pudo limpiar archivos temporales: {e}")
 
+        # El detector sigue en caché; solo se liberan los buffers de la inferencia
+        free_gpu_memory()
+
 
 # Ejecutar app
 if __name__ == "__main__":
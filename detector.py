@@ -3,27 +3,43 @@ Módulo de detección y tracking de ciclistas usando YOLOv11
 """
 import cv2
 import numpy as np
+import torch
+from numba import njit, prange
 from ultralytics import YOLO
-from typing import List, Tuple, Dict
+from typing import List, Optional, Tuple, Dict
+import gc
 import logging
 import os
+import queue
 import subprocess
 import shutil
+import threading
+from functools import lru_cache
+
+try:
+    import av  # PyAV (opcional): decodificación por hardware con NVDEC
+except ImportError:
+    av = None
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
-def convert_video_to_h264(input_path: str, output_path: str = None) -> str:
+def convert_video_to_h264(input_path: str, output_path: str = None, use_hw_encoder: bool = False) -> str:
     """
     Convierte un video a formato H.264 compatible con navegadores web usando FFmpeg.
 
     Esta función es esencial para Streamlit Cloud, donde el reproductor de video
     del navegador solo soporta H.264, no mp4v ni otros codecs de OpenCV.
 
+    Con use_hw_encoder=True se usa primero el encoder por hardware (NVENC/VAAPI)
+    si hay uno; con NVENC la decodificación también se hace en GPU (-hwaccel
+    cuda). Si falla, se repite la conversión con libx264.
+
     Args:
         input_path: Ruta al video de entrada
-        output_path: Ruta al video de salida (si None, se usa input_path_h264.mp4)
+        output_path: Ruta al video de salida (si None, se usa {base}_processed_h264.mp4)
+        use_hw_encoder: Si True, intenta codificar por hardware antes que con libx264
 
     Returns:
         Ruta al video convertido
@@ -38,43 +54,50 @@ def convert_video_to_h264(input_path: str, output_path: str = None) -> str:
 
     # Determinar ruta de salida
     if output_path is None:
-        base_path = input_path.replace('_processed.mp4', '')
+        base_path = os.path.splitext(input_path)[0].removesuffix('_processed')
         output_path = f"{base_path}_processed_h264.mp4"
 
+    encoders = ['libx264']
+    hw_encoder = find_hw_h264_encoder() if use_hw_encoder else None
+    if hw_encoder:
+        encoders.insert(0, hw_encoder)
+
     try:
-        logger.info(f"🔄 Convirtiendo video a H.264 para compatibilidad web...")
-
-        # Comando FFmpeg optimizado para web
-        # -c:v libx264: codec H.264
-        # -preset fast: velocidad de encoding
-        # -crf 23: calidad (18-28, menor = mejor calidad)
-        # -pix_fmt yuv420p: formato de pixel compatible con navegadores
-        # -movflags +faststart: optimiza para streaming web
-        # -c:a copy: copiar audio sin recodificar (si existe)
-        cmd = [
-            'ffmpeg',
-            '-i', input_path,
-            '-c:v', 'libx264',
-            '-preset', 'fast',
-            '-crf', '23',
-            '-pix_fmt', 'yuv420p',
-            '-movflags', '+faststart',
-            '-c:a', 'aac',  # codec de audio compatible
-            '-b:a', '128k',  # bitrate de audio
-            '-y',  # sobrescribir si existe
-            output_path
-        ]
+        for encoder in encoders:
+            logger.info(f"🔄 Convirtiendo video a H.264 ({encoder}) para compatibilidad web...")
 
-        # Ejecutar FFmpeg
-        result = subprocess.run(
-            cmd,
-            capture_output=True,
-            text=True,
-            timeout=300  # timeout de 5 minutos
-        )
+            # Comando FFmpeg optimizado para web
+            # H264_ENCODERS: codec H.264, velocidad de encoding, calidad y
+            #   formato de pixel compatible con navegadores (yuv420p)
+            # -movflags +faststart: optimiza para streaming web
+            # -c:a aac: recodificar audio (si existe) a un codec compatible
+            input_args, output_args = H264_ENCODERS[encoder]
+            if encoder == 'h264_nvenc':
+                input_args = ['-hwaccel', 'cuda', *input_args]
+            cmd = [
+                'ffmpeg',
+                *input_args,
+                '-i', input_path,
+                *output_args,
+                '-movflags', '+faststart',
+                '-c:a', 'aac',  # codec de audio compatible
+                '-b:a', '128k',  # bitrate de audio
+                '-y',  # sobrescribir si existe
+                output_path
+            ]
+
+            # Ejecutar FFmpeg
+            result = subprocess.run(
+                cmd,
+                capture_output=True,
+                text=True,
+                timeout=300  # timeout de 5 minutos
+            )
 
-        if result.returncode != 0:
-            logger.error(f"❌ Error en FFmpeg: {result.stderr}")
+            if result.returncode == 0:
+                break
+            logger.error(f"❌ Error en FFmpeg ({encoder}): {result.stderr}")
+        else:
             logger.warning("⚠️ Usando video original sin conversión")
             return input_path
 
@@ -103,6 +126,509 @@ def convert_video_to_h264(input_path: str, output_path: str = None) -> str:
         return input_path
 
 
+def downscale_video(input_path: str, max_short_side: int, output_path: str = None) -> str:
+    """
+    Reduce la resolución de un video con FFmpeg antes de analizarlo.
+
+    YOLO redimensiona internamente cada frame a 640 px, así que decodificar,
+    anotar y codificar frames 1080p/4K solo gasta tiempo. El lado corto se
+    limita a max_short_side conservando la proporción.
+
+    Args:
+        input_path: Ruta al video de entrada
+        max_short_side: Lado corto máximo en píxeles (p. ej. 720 o 480)
+        output_path: Ruta al video de salida (si None, se usa input_path_{max_short_side}p.mp4)
+
+    Returns:
+        Ruta al video reducido, o input_path si no hace falta reducirlo o FFmpeg falla
+    """
+    cap = cv2.VideoCapture(input_path)
+    width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+    height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    cap.release()
+
+    if min(width, height) <= max_short_side:
+        return input_path
+
+    if not shutil.which('ffmpeg'):
+        logger.warning("⚠️ FFmpeg no está disponible. Se analizará el video en su resolución original.")
+        return input_path
+
+    if output_path is None:
+        output_path = input_path.replace('.mp4', f'_{max_short_side}p.mp4')
+
+    # -2 mantiene la proporción con una dimensión par (requerida por H.264)
+    scale = f"-2:{max_short_side}" if width >= height else f"{max_short_side}:-2"
+
+    try:
+        logger.info(f"🔄 Reduciendo resolución {width}x{height} -> {max_short_side}p para el análisis...")
+        cmd = [
+            'ffmpeg',
+            '-i', input_path,
+            '-vf', f'scale={scale}',
+            '-c:v', 'libx264',
+            '-preset', 'veryfast',
+            '-crf', '23',
+            '-an',  # el video anotado no lleva audio
+            '-y',
+            output_path
+        ]
+        result = subprocess.run(cmd, capture_output=True, text=True, timeout=300)
+
+        if result.returncode != 0 or not os.path.exists(output_path):
+            logger.error(f"❌ Error reduciendo resolución: {result.stderr}")
+            return input_path
+
+        logger.info(f"✅ Video reducido: {output_path}")
+        return output_path
+
+    except subprocess.TimeoutExpired:
+        logger.error("❌ FFmpeg timeout al reducir la resolución")
+        return input_path
+    except Exception as e:
+        logger.error(f"❌ Error reduciendo resolución: {e}")
+        return input_path
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def iou_matrix(boxes_a: np.ndarray, boxes_b: np.ndarray) -> np.ndarray:
+    """
+    Calcula la matriz de IoU entre dos conjuntos de cajas (compilado con Numba)
+
+    Args:
+        boxes_a: Array float32 (N, 4) en formato x1y1x2y2
+        boxes_b: Array float32 (M, 4) en formato x1y1x2y2
+
+    Returns:
+        Array float32 (N, M) con el IoU de cada par de cajas
+    """
+    n = boxes_a.shape[0]
+    m = boxes_b.shape[0]
+    ious = np.zeros((n, m), dtype=np.float32)
+
+    for i in prange(n):
+        ax1, ay1, ax2, ay2 = boxes_a[i, 0], boxes_a[i, 1], boxes_a[i, 2], boxes_a[i, 3]
+        area_a = (ax2 - ax1) * (ay2 - ay1)
+        for j in range(m):
+            bx1, by1, bx2, by2 = boxes_b[j, 0], boxes_b[j, 1], boxes_b[j, 2], boxes_b[j, 3]
+            inter_w = min(ax2, bx2) - max(ax1, bx1)
+            inter_h = min(ay2, by2) - max(ay1, by1)
+            if inter_w <= 0 or inter_h <= 0:
+                continue
+            inter = inter_w * inter_h
+            area_b = (bx2 - bx1) * (by2 - by1)
+            ious[i, j] = inter / (area_a + area_b - inter + 1e-7)
+
+    return ious
+
+
+@njit(cache=True)
+def update_crossings(track_ids: np.ndarray, centers: np.ndarray, prev_xy: np.ndarray,
+                     has_prev: np.ndarray, crossed_ids: np.ndarray, line_coords: np.ndarray,
+                     rules: np.ndarray) -> Tuple[np.ndarray, int]:
+    """
+    Detecta los cruces de línea de un frame y actualiza el estado de los tracks (compilado con Numba)
+
+    Un track sin posición previa no puede cruzar. Cada track se cuenta una
+    sola vez por sentido; prev_xy, has_prev y crossed_ids se modifican in situ.
+
+    Args:
+        track_ids: Array int (N,) con los IDs de los tracks del frame
+        centers: Array int32 (N, 2) con el centro (x, y) de cada caja
+        prev_xy: Array int32 (capacidad, 2) con el centro previo de cada track
+        has_prev: Array bool (capacidad,) que indica si el track tiene posición previa
+        crossed_ids: Array bool (4, capacidad) con los tracks contados por sentido
+        line_coords: Array int32 (2,) con la posición (x, y) de las líneas
+        rules: Array int (R, 3) de reglas (eje, sentido, fila de crossed_ids);
+            eje 0 = x, eje 1 = y; sentido -1 = hacia coordenadas menores, +1 = mayores
+
+    Returns:
+        Tupla (eventos, nuevos únicos): eventos es un array int (K, 2) con
+        (índice de regla, track_id) de cada cruce nuevo, en orden de regla y
+        de detección; nuevos únicos es la cantidad de tracks que cruzaron por
+        primera vez en cualquier sentido
+    """
+    n = track_ids.shape[0]
+    events = np.empty((rules.shape[0] * n, 2), dtype=np.int64)
+    n_events = 0
+    new_unique = 0
+
+    for r in range(rules.shape[0]):
+        axis, direction, row = rules[r, 0], rules[r, 1], rules[r, 2]
+        line = line_coords[axis]
+        for i in range(n):
+            track_id = track_ids[i]
+            if not has_prev[track_id] or crossed_ids[row, track_id]:
+                continue
+            prev_side = prev_xy[track_id, axis] - line
+            curr_side = centers[i, axis] - line
+            if direction < 0:
+                crossed = prev_side > 0 and curr_side <= 0
+            else:
+                crossed = prev_side < 0 and curr_side >= 0
+            if not crossed:
+                continue
+            # Track que no había cruzado en ningún sentido
+            if not (crossed_ids[0, track_id] or crossed_ids[1, track_id]
+                    or crossed_ids[2, track_id] or crossed_ids[3, track_id]):
+                new_unique += 1
+            crossed_ids[row, track_id] = True
+            events[n_events, 0] = r
+            events[n_events, 1] = track_id
+            n_events += 1
+
+    # Actualizar posiciones
+    for i in range(n):
+        prev_xy[track_ids[i], 0] = centers[i, 0]
+        prev_xy[track_ids[i], 1] = centers[i, 1]
+        has_prev[track_ids[i]] = True
+
+    return events[:n_events], new_unique
+
+
+def use_numba_iou_in_tracker():
+    """
+    Hace que BoT-SORT calcule la matriz de costo IoU con iou_matrix (Numba)
+
+    El matching de los trackers de Ultralytics llama a bbox_ioa(..., iou=True)
+    en cada frame; se reemplaza esa llamada manteniendo la original para el
+    resto de usos.
+    """
+    try:
+        from ultralytics.trackers.utils import matching
+    except ImportError as e:
+        logger.warning(f"⚠️ No se pudo acelerar el matching de BoT-SORT: {e}")
+        return
+
+    original_bbox_ioa = matching.bbox_ioa
+    if getattr(original_bbox_ioa, 'uses_numba', False):
+        return
+
+    def bbox_ioa(box1, box2, iou=False, eps=1e-7):
+        if iou:
+            return iou_matrix(box1, box2)
+        return original_bbox_ioa(box1, box2, iou=iou, eps=eps)
+
+    bbox_ioa.uses_numba = True
+    matching.bbox_ioa = bbox_ioa
+
+
+use_numba_iou_in_tracker()
+
+
+def free_gpu_memory():
+    """Libera los objetos sin referencias y devuelve al driver la memoria CUDA cacheada"""
+    gc.collect()
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+
+# Encoders H.264 por hardware, en orden de preferencia:
+# nombre -> (argumentos antes de la entrada, argumentos de salida)
+HW_H264_ENCODERS = {
+    'h264_nvenc': (
+        [],
+        ['-c:v', 'h264_nvenc', '-preset', 'p4', '-cq', '23', '-pix_fmt', 'yuv420p'],
+    ),
+    'h264_vaapi': (
+        ['-vaapi_device', '/dev/dri/renderD128'],
+        ['-vf', 'format=nv12,hwupload', '-c:v', 'h264_vaapi', '-qp', '23'],
+    ),
+}
+
+# Todos los encoders utilizables por FFmpegWriter y convert_video_to_h264:
+# los de hardware más libx264 en CPU. Para libx264, el preset faster es mucho
+# más rápido que fast con una pérdida de calidad imperceptible, y fastdecode
+# aligera la reproducción en el navegador (no se usa zerolatency: desactiva
+# los B-frames y aquí la latencia no importa).
+H264_ENCODERS = {
+    **HW_H264_ENCODERS,
+    'libx264': (
+        [],
+        ['-c:v', 'libx264', '-preset', 'faster', '-tune', 'fastdecode', '-crf', '23', '-pix_fmt', 'yuv420p'],
+    ),
+}
+
+
+@lru_cache(maxsize=None)
+def find_hw_h264_encoder() -> Optional[str]:
+    """
+    Busca un encoder H.264 por hardware que funcione en este host.
+
+    FFmpeg puede listar h264_nvenc aunque no haya GPU, así que cada candidato
+    se prueba codificando un clip sintético de 0.1 segundos. El resultado se
+    cachea durante la vida del proceso.
+
+    Returns:
+        Nombre del encoder ('h264_nvenc' o 'h264_vaapi') o None si no hay ninguno
+    """
+    if not shutil.which('ffmpeg'):
+        return None
+
+    for name, (input_args, output_args) in HW_H264_ENCODERS.items():
+        cmd = [
+            'ffmpeg', '-hide_banner', '-loglevel', 'error',
+            *input_args,
+            '-f', 'lavfi', '-i', 'color=black:s=256x256:d=0.1',
+            *output_args,
+            '-f', 'null', '-'
+        ]
+        try:
+            result = subprocess.run(cmd, capture_output=True, timeout=30)
+        except (subprocess.SubprocessError, OSError):
+            continue
+        if result.returncode == 0:
+            logger.info(f"✅ Encoder por hardware disponible: {name}")
+            return name
+
+    return None
+
+
+class FFmpegWriter:
+    """
+    Escritor de video que envía frames BGR a FFmpeg por un pipe.
+
+    Codifica directamente a H.264 (compatible con navegadores), sin archivo
+    intermedio. Expone la misma interfaz write()/release() que cv2.VideoWriter.
+    """
+
+    def __init__(self, output_path: str, fps: float, size: Tuple[int, int], encoder: str):
+        """
+        Lanza el proceso de FFmpeg
+
+        Args:
+            output_path: Ruta del video H.264 de salida
+            fps: Frames por segundo del video de salida
+            size: (ancho, alto) de los frames
+            encoder: Nombre del encoder en H264_ENCODERS
+        """
+        width, height = size
+        input_args, output_args = H264_ENCODERS[encoder]
+        cmd = [
+            'ffmpeg', '-y', '-hide_banner', '-loglevel', 'error',
+            *input_args,
+            '-f', 'rawvideo', '-pix_fmt', 'bgr24',
+            '-s', f'{width}x{height}', '-r', str(fps),
+            '-i', '-',
+            *output_args,
+            '-movflags', '+faststart',
+            output_path
+        ]
+        self.output_path = output_path
+        self._proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    def isOpened(self) -> bool:
+        return self._proc.poll() is None
+
+    def write(self, frame: np.ndarray):
+        self._proc.stdin.write(np.ascontiguousarray(frame).data)
+
+    @property
+    def returncode(self) -> Optional[int]:
+        """Código de salida de FFmpeg (None mientras sigue en ejecución)"""
+        return self._proc.returncode
+
+    def release(self):
+        """Cierra el pipe y espera a que FFmpeg termine de escribir el archivo"""
+        _, stderr = self._proc.communicate()
+        if self._proc.returncode != 0:
+            logger.error(f"❌ Error en FFmpeg: {stderr.decode(errors='replace')}")
+
+
+class VideoReader:
+    """
+    Lector de video con decodificación por hardware (NVDEC) cuando está disponible
+
+    En hosts con CUDA y PyAV instalado decodifica con NVDEC; en otro caso usa
+    cv2.VideoCapture. Expone la misma interfaz read()/release() que OpenCV y
+    entrega frames BGR uint8, ya que el dibujo y la escritura se hacen en CPU.
+    """
+
+    def __init__(self, video_path: str, use_hw_decode: bool = True):
+        """
+        Abre el video
+
+        Args:
+            video_path: Ruta al video
+            use_hw_decode: Si True, intenta decodificar con NVDEC (requiere CUDA + PyAV)
+        """
+        self.video_path = video_path
+        self.backend = None
+        self._cap = None
+        self._container = None
+        self._frames = None
+        self._grabbed = None
+
+        if use_hw_decode and av is not None and torch.cuda.is_available():
+            try:
+                self._open_nvdec()
+            except Exception as e:
+                logger.warning(f"⚠️ NVDEC no disponible ({e}). Usando decodificación por CPU.")
+                self._close_container()
+
+        if self._container is None:
+            self._open_opencv()
+
+        logger.info(f"🎞️ Decodificando con {self.backend}")
+
+    def _open_nvdec(self):
+        """Abre el video con PyAV usando el decodificador CUDA"""
+        from av.codec.hwaccel import HWAccel
+
+        self._container = av.open(self.video_path, hwaccel=HWAccel(device_type="cuda"))
+        stream = self._container.streams.video[0]
+        self.fps = int(round(float(stream.average_rate or 0)))
+        self.width = stream.codec_context.width
+        self.height = stream.codec_context.height
+        self.total_frames = stream.frames
+        if not self.total_frames and stream.duration:
+            self.total_frames = int(float(stream.duration * stream.time_base) * self.fps)
+        self._frames = self._container.decode(stream)
+        self.backend = "NVDEC (PyAV)"
+
+    def _open_opencv(self):
+        """Abre el video con cv2.VideoCapture (decodificación por CPU)"""
+        # Backend FFmpeg explícito (evita que OpenCV pruebe GStreamer/otros) y
+        # buffer interno mínimo: los frames ya se encolan en el hilo lector
+        self._cap = cv2.VideoCapture(self.video_path, cv2.CAP_FFMPEG)
+        self._cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+        # Misma conversión que con NVDEC: 29.97 -> 30 (truncar daría 29)
+        self.fps = int(round(self._cap.get(cv2.CAP_PROP_FPS)))
+        self.width = int(self._cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+        self.height = int(self._cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        self.total_frames = int(self._cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        self.backend = "OpenCV (CPU)"
+
+    def _close_container(self):
+        if self._container is not None:
+            self._container.close()
+        self._container = None
+        self._frames = None
+
+    @property
+    def info(self) -> Dict:
+        """Propiedades del video: ancho, alto, FPS y número de frames"""
+        return {
+            'width': self.width,
+            'height': self.height,
+            'fps': self.fps,
+            'total_frames': self.total_frames,
+        }
+
+    def isOpened(self) -> bool:
+        if self._cap is not None:
+            return self._cap.isOpened()
+        return self._container is not None
+
+    def read(self) -> Tuple[bool, np.ndarray]:
+        """Lee el siguiente frame como array BGR (misma semántica que cv2.VideoCapture.read)"""
+        if self._cap is not None:
+            return self._cap.read()
+        try:
+            frame = next(self._frames)
+        except (StopIteration, av.FFmpegError):
+            return False, None
+        return True, frame.to_ndarray(format="bgr24")
+
+    def grab(self) -> bool:
+        """Avanza al siguiente frame sin convertirlo a BGR (misma semántica que cv2.VideoCapture.grab)"""
+        if self._cap is not None:
+            return self._cap.grab()
+        try:
+            self._grabbed = next(self._frames)
+        except (StopIteration, av.FFmpegError):
+            self._grabbed = None
+        return self._grabbed is not None
+
+    def retrieve(self) -> Tuple[bool, np.ndarray]:
+        """Convierte a BGR el último frame obtenido con grab()"""
+        if self._cap is not None:
+            return self._cap.retrieve()
+        if self._grabbed is None:
+            return False, None
+        return True, self._grabbed.to_ndarray(format="bgr24")
+
+    def release(self):
+        if self._cap is not None:
+            self._cap.release()
+        self._close_container()
+
+
+# Capacidad de las colas entre los hilos de lectura, inferencia y escritura
+PIPELINE_QUEUE_SIZE = 8
+
+
+def _put_unless_stopped(q: queue.Queue, item, stop_event: threading.Event) -> bool:
+    """Encola item esperando si la cola está llena; desiste si se activa stop_event"""
+    while not stop_event.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _get_unless_stopped(q: queue.Queue, stop_event: threading.Event):
+    """Desencola un elemento esperando si la cola está vacía; devuelve None si se activa stop_event"""
+    while True:
+        try:
+            return q.get(timeout=0.1)
+        except queue.Empty:
+            if stop_event.is_set():
+                return None
+
+
+def _read_frames(cap, frame_queue: queue.Queue, stop_event: threading.Event, errors: list, every_n: int = 1):
+    """
+    Hilo lector: decodifica el video y encola (frame_idx, frame)
+
+    Con every_n > 1 solo se encolan los frames múltiplos de every_n; el resto
+    se avanza con grab() sin convertirlo a BGR ni copiarlo. Al terminar encola
+    None para marcar el final del video.
+    """
+    frame_idx = 0
+    try:
+        while not stop_event.is_set():
+            if not cap.grab():
+                break
+            frame_idx += 1
+            if frame_idx % every_n != 0:
+                continue
+            ret, frame = cap.retrieve()
+            if not ret:
+                break
+            if not _put_unless_stopped(frame_queue, (frame_idx, frame), stop_event):
+                break
+    except Exception as e:
+        errors.append(e)
+        stop_event.set()
+    finally:
+        _put_unless_stopped(frame_queue, None, stop_event)
+
+
+def _write_frames(out, write_queue: queue.Queue, progress_callback, stop_event: threading.Event, errors: list):
+    """
+    Hilo escritor: codifica los frames anotados en orden
+
+    Cada elemento es (frame, progreso); progreso es None o (percent, mensaje)
+    y se reporta después de escribir el frame, de modo que el porcentaje
+    refleja el video ya codificado. None marca el final.
+    """
+    try:
+        while True:
+            item = _get_unless_stopped(write_queue, stop_event)
+            if item is None:
+                return
+            frame, progress = item
+            out.write(frame)
+            if progress and progress_callback:
+                progress_callback(*progress)
+    except Exception as e:
+        errors.append(e)
+        stop_event.set()
+
+
 class CyclistDetector:
     """
     Detector de ciclistas usando YOLOv11 con tracking BoT-SORT
@@ -111,8 +637,46 @@ class CyclistDetector:
     # Clases en COCO dataset
     PERSON_CLASS_ID = 0
     BICYCLE_CLASS_ID = 1
+
+    # Backends de inferencia -> formato de exportación de Ultralytics
+    # (None = usar el checkpoint PyTorch .pt directamente)
+    BACKEND_FORMATS = {
+        "torch": None,
+        "onnx": "onnx",    # ONNX-Runtime (CPU / Streamlit Cloud)
+        "trt": "engine",   # TensorRT (GPU NVIDIA)
+    }
+
+    # Color (BGR) de las cajas y labels de detección
+    BOX_COLOR = (0, 255, 0)
+
+    # Precisiones numéricas soportadas para la inferencia
+    PRECISIONS = ("fp32", "fp16", "int8")
+
+    # Orientación de las líneas de conteo como flags de bits
+    LINE_H, LINE_V = 1, 2
+    LINE_ORIENTATIONS = {"horizontal": LINE_H, "vertical": LINE_V, "both": LINE_H | LINE_V}
+
+    # Sentidos de cruce (filas del array de IDs contados)
+    UP, DOWN, LEFT, RIGHT = range(4)
+
+    # Capacidad inicial de los arrays de estado por track_id
+    TRACK_CAPACITY = 1024
+
+    # Frames por llamada al modelo en GPU cuando no se indica batch_size
+    DEFAULT_BATCH_SIZE = 8
+
+    # Tamaño de entrada del modelo: los motores TensorRT se compilan para esta
+    # forma, así que export() y track() deben usar el mismo valor
+    IMGSZ = 640
     
-    def __init__(self, model_size: str = "n", conf_threshold: float = 0.15, detect_persons: bool = False):
+    def __init__(
+        self,
+        model_size: str = "n",
+        conf_threshold: float = 0.15,
+        detect_persons: bool = False,
+        backend: str = "torch",
+        precision: Optional[str] = None
+    ):
         """
         Inicializa el detector
         
@@ -120,10 +684,32 @@ class CyclistDetector:
             model_size: 'n' (nano) o 's' (small)
             conf_threshold: Umbral de confianza (0-1) - 0.15 recomendado
             detect_persons: Si True, detecta personas además de bicicletas (puede causar falsos positivos)
+            backend: 'torch' (PyTorch), 'onnx' (ONNX-Runtime) o 'trt' (TensorRT)
+            precision: 'fp32', 'fp16' (GPU) o 'int8' (cuantizado, pierde algo de precisión).
+                Si es None, FP16 con GPU y FP32 en CPU (ver default_precision)
         """
+        if precision is None:
+            precision = self.default_precision()
+        if backend not in self.BACKEND_FORMATS:
+            raise ValueError(f"Backend no soportado: {backend} (opciones: {list(self.BACKEND_FORMATS)})")
+        if precision not in self.PRECISIONS:
+            raise ValueError(f"Precisión no soportada: {precision} (opciones: {list(self.PRECISIONS)})")
+
+        # PyTorch no tiene ruta INT8 en Ultralytics: se usa FP32
+        if backend == "torch" and precision == "int8":
+            logger.warning("⚠️ INT8 no está disponible con PyTorch. Usando FP32 (elige ONNX o TensorRT para INT8)")
+            precision = "fp32"
+
         self.model_size = model_size
         self.conf_threshold = conf_threshold
         self.detect_persons = detect_persons
+        self.backend = backend
+        self.precision = precision
+        self.half = False  # FP16 en tiempo de inferencia (solo aplica a PyTorch)
+        self.max_batch_size = None  # Lote máximo del modelo cargado (None = sin límite)
+        # El detector se comparte entre sesiones (st.cache_resource) y el tracker
+        # de BoT-SORT guarda estado: se procesa un video a la vez
+        self.lock = threading.Lock()
         
         # Configurar clases a detectar
         if detect_persons:
@@ -136,17 +722,218 @@ class CyclistDetector:
         self.model = None
         self._load_model()
         
+    @staticmethod
+    def default_backend() -> str:
+        """Backend por defecto: TensorRT si hay GPU CUDA, ONNX-Runtime en CPU"""
+        return "trt" if torch.cuda.is_available() else "onnx"
+
+    @staticmethod
+    def default_precision() -> str:
+        """Precisión por defecto: FP16 si hay GPU CUDA (tensor cores), FP32 en CPU"""
+        return "fp16" if torch.cuda.is_available() else "fp32"
+
     def _load_model(self):
-        """Carga el modelo YOLOv11"""
+        """Carga el modelo YOLOv11 con el backend de inferencia seleccionado"""
         try:
             model_name = f"yolo11{self.model_size}.pt"
-            logger.info(f"Cargando modelo: {model_name}")
-            self.model = YOLO(model_name)
-            logger.info(f"✅ Modelo {model_name} cargado exitosamente")
+            weights = self._export_model(model_name)
+            logger.info(f"Cargando modelo: {weights} (backend: {self.backend}, precisión: {self.precision})")
+            self.model = YOLO(weights, task="detect")
+            # Los modelos exportados ya llevan la precisión incorporada;
+            # con PyTorch el FP16 se pide en cada llamada a track()
+            self.half = weights.endswith('.pt') and self.precision == "fp16"
+            # El motor TensorRT solo acepta lotes dentro de su perfil de
+            # optimización, cuyo máximo es el batch con el que se exportó
+            if weights.endswith('.engine'):
+                self.max_batch_size = self.DEFAULT_BATCH_SIZE
+            if weights.endswith('.pt'):
+                # Con imgsz fijo la forma de entrada no cambia dentro de un video:
+                # cuDNN elige el mejor algoritmo en la primera inferencia y lo reutiliza
+                if torch.cuda.is_available():
+                    torch.backends.cudnn.benchmark = True
+            logger.info(f"✅ Modelo {weights} cargado exitosamente")
         except Exception as e:
             logger.error(f"❌ Error cargando modelo: {e}")
             raise
-    
+
+    def _export_model(self, model_name: str) -> str:
+        """
+        Exporta el modelo PyTorch al formato del backend (solo la primera vez)
+
+        El archivo exportado (yolo11{n,s}_{precision}_{parámetros}.{onnx,engine}) se
+        guarda junto a los pesos .pt y se reutiliza en ejecuciones posteriores. Si la
+        exportación falla (p. ej. TensorRT sin GPU), se usa el modelo PyTorch original.
+
+        Args:
+            model_name: Nombre del checkpoint PyTorch (yolo11n.pt / yolo11s.pt)
+
+        Returns:
+            Ruta a los pesos a cargar con YOLO()
+        """
+        export_format = self.BACKEND_FORMATS[self.backend]
+        if export_format is None:
+            return model_name
+
+        export_path = model_name.replace('.pt', f'_{self.precision}_{self._export_tag()}.{export_format}')
+        if os.path.exists(export_path):
+            logger.info(f"♻️ Usando modelo exportado en caché: {export_path}")
+            return export_path
+
+        try:
+            logger.info(f"🔄 Exportando {model_name} a {export_format} {self.precision.upper()} (solo la primera vez)...")
+            if export_format == "onnx" and self.precision == "int8":
+                self._quantize_onnx_int8(model_name, export_path)
+            else:
+                # Batch dinámico: los lotes de detect_and_track se ejecutan en
+                # una sola llamada en lugar de partirse en lotes de 1
+                export_kwargs = {
+                    'format': export_format,
+                    'half': self.precision == "fp16",
+                    'dynamic': True,
+                    'batch': self.DEFAULT_BATCH_SIZE,
+                    'imgsz': self.IMGSZ,
+                }
+                if export_format == "engine":
+                    # TensorRT requiere GPU; INT8 necesita un dataset de calibración
+                    export_kwargs.update(device=0, int8=self.precision == "int8")
+                    if self.precision == "int8":
+                        export_kwargs['data'] = "coco128.yaml"
+                elif self.precision == "fp16":
+                    export_kwargs['device'] = 0  # ONNX FP16 solo se exporta en GPU
+                exported_path = YOLO(model_name).export(**export_kwargs)
+                os.replace(exported_path, export_path)
+            logger.info(f"✅ Modelo exportado: {export_path}")
+            return export_path
+        except Exception as e:
+            logger.warning(f"⚠️ No se pudo exportar a {export_format} {self.precision}: {e}. Usando modelo PyTorch.")
+            return model_name
+
+    def _export_tag(self) -> str:
+        """
+        Parámetros de exportación codificados en el nombre del modelo en caché
+
+        Un archivo exportado con otros parámetros (p. ej. estático con batch 1)
+        tiene otro nombre, así que no se reutiliza por error.
+
+        Returns:
+            Sufijo del nombre del archivo (p. ej. 'dyn_b8_640')
+        """
+        return f"dyn_b{self.DEFAULT_BATCH_SIZE}_{self.IMGSZ}"
+
+    def _quantize_onnx_int8(self, model_name: str, output_path: str) -> None:
+        """
+        Genera un modelo ONNX INT8 mediante cuantización dinámica de ONNX-Runtime
+
+        La cuantización dinámica no necesita datos de calibración y pierde mucho
+        menos mAP que la cuantización estática INT8.
+
+        Args:
+            model_name: Nombre del checkpoint PyTorch
+            output_path: Ruta del modelo ONNX cuantizado
+        """
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+
+        fp32_path = model_name.replace('.pt', f'_fp32_{self._export_tag()}.onnx')
+        if not os.path.exists(fp32_path):
+            exported_path = YOLO(model_name).export(
+                format="onnx", dynamic=True, batch=self.DEFAULT_BATCH_SIZE, imgsz=self.IMGSZ
+            )
+            os.replace(exported_path, fp32_path)
+
+        quantize_dynamic(fp32_path, output_path, weight_type=QuantType.QUInt8)
+
+    @staticmethod
+    def _render_line_overlay(
+        width: int, height: int, line_x: int, line_y: int, use_line_h: bool, use_line_v: bool
+    ) -> Tuple[Tuple[np.ndarray, np.ndarray], np.ndarray]:
+        """
+        Dibuja las líneas de conteo y sus etiquetas en una capa aparte
+
+        Args:
+            width: Ancho del video
+            height: Alto del video
+            line_x: Posición en píxeles de la línea vertical
+            line_y: Posición en píxeles de la línea horizontal
+            use_line_h: Si se dibuja la línea horizontal
+            use_line_v: Si se dibuja la línea vertical
+
+        Returns:
+            Tupla ((filas, columnas), colores BGR) de los píxeles dibujados,
+            lista para copiarse sobre cada frame con frame[pixels] = colors
+        """
+        overlay = np.zeros((height, width, 3), dtype=np.uint8)
+        mask = np.zeros((height, width), dtype=np.uint8)
+
+        # Mismo trazo sobre la capa de color y sobre la máscara
+        for canvas, is_mask in ((overlay, False), (mask, True)):
+            if use_line_h:
+                color = 255 if is_mask else (0, 255, 255)
+                cv2.line(canvas, (0, line_y), (width, line_y), color, 3)
+                cv2.putText(canvas, "LINEA HORIZONTAL", (10, line_y - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.6, color, 2)
+            if use_line_v:
+                color = 255 if is_mask else (255, 0, 255)
+                cv2.line(canvas, (line_x, 0), (line_x, height), color, 3)
+                cv2.putText(canvas, "LINEA VERTICAL", (line_x + 10, 30), cv2.FONT_HERSHEY_SIMPLEX, 0.6, color, 2)
+
+        pixels = np.nonzero(mask)
+        return pixels, overlay[pixels]
+
+    @staticmethod
+    def _render_text_overlay(
+        lines: List[str], width: int, height: int
+    ) -> Tuple[Tuple[int, int, int, int], np.ndarray]:
+        """
+        Rasteriza una sola vez texto blanco (uno por renglón, desde la esquina superior izquierda)
+
+        Args:
+            lines: Textos a dibujar
+            width: Ancho del video
+            height: Alto del video
+
+        Returns:
+            Tupla ((x, y, w, h) del área con texto, alfa de 3 canales de esa área)
+        """
+        mask = np.zeros((height, width), dtype=np.uint8)
+        for i, text in enumerate(lines):
+            cv2.putText(mask, text, (10, 30 + i * 30), cv2.FONT_HERSHEY_SIMPLEX, 0.7, 255, 2, cv2.LINE_AA)
+        x, y, w, h = cv2.boundingRect(mask)
+        return (x, y, w, h), cv2.merge([mask[y:y + h, x:x + w]] * 3)
+
+    @staticmethod
+    def _blend_text_overlay(frame: np.ndarray, rect: Tuple[int, int, int, int], alpha: np.ndarray) -> None:
+        """Mezcla en el frame (in-place) el texto blanco renderizado con _render_text_overlay"""
+        x, y, w, h = rect
+        if w == 0 or h == 0:
+            return
+        roi = frame[y:y + h, x:x + w]
+        # roi + (255 - roi) * alfa / 255: mismo resultado que putText con antialiasing
+        cv2.add(roi, cv2.multiply(cv2.bitwise_not(roi), alpha, scale=1 / 255), dst=roi)
+
+    @staticmethod
+    def _probe_output(output_path: str) -> None:
+        """Abre el video generado con OpenCV y registra su número de frames"""
+        try:
+            test_cap = cv2.VideoCapture(output_path)
+            if not test_cap.isOpened():
+                logger.warning("⚠️ El video generado no se puede abrir, pero el archivo existe")
+            else:
+                test_frames = int(test_cap.get(cv2.CAP_PROP_FRAME_COUNT))
+                logger.debug(f"✅ Video validado: {test_frames} frames")
+                test_cap.release()
+        except Exception as e:
+            logger.warning(f"⚠️ No se pudo validar el video: {e}")
+
+    def _reset_tracker(self):
+        """
+        Reinicia el estado de BoT-SORT (tracks e IDs)
+
+        El modelo se reutiliza entre videos, y con persist=True Ultralytics
+        conservaría los tracks del video anterior.
+        """
+        predictor = getattr(self.model, 'predictor', None)
+        for tracker in getattr(predictor, 'trackers', None) or []:
+            tracker.reset()
+
     def detect_and_track(
         self,
         video_path: str,
@@ -154,7 +941,12 @@ class CyclistDetector:
         line_position_x: float = 0.5,
         line_orientation: str = "horizontal",
         process_every_n_frames: int = 1,
-        progress_callback=None
+        progress_callback=None,
+        batch_size: Optional[int] = None,
+        hw_encode: bool = False,
+        skip_empty_frames: bool = False,
+        cancel_event: Optional[threading.Event] = None,
+        conf_threshold: Optional[float] = None
     ) -> Tuple[str, Dict]:
         """
         Detecta y rastrea ciclistas en video
@@ -164,261 +956,389 @@ class CyclistDetector:
             line_position: Posición de línea de conteo horizontal (0-1, fracción de altura)
             line_position_x: Posición de línea de conteo vertical (0-1, fracción de ancho)
             line_orientation: "horizontal", "vertical" o "both"
-            process_every_n_frames: Procesar cada N frames (para velocidad)
+            process_every_n_frames: Procesar cada N frames (para velocidad). El video de
+                salida contiene solo los frames procesados, a fps / N
             progress_callback: Función callback(progress_percent, status_message)
+            batch_size: Frames procesados por cada llamada al modelo (lotes > 1 aprovechan mejor la GPU).
+                Si es None, usa DEFAULT_BATCH_SIZE con GPU y 1 en CPU
+            hw_encode: Si True, codifica el video de salida con NVENC/VAAPI cuando esté disponible
+            skip_empty_frames: Si True, omite del video de salida los frames sin detecciones
+            cancel_event: Evento que, al activarse, cancela el procesamiento (InterruptedError)
+            conf_threshold: Umbral de confianza para este video (None = el del detector)
 
         Returns:
             Tupla de (ruta_video_procesado, diccionario_metricas)
         """
-        cap = cv2.VideoCapture(video_path)
+        # Un video a la vez por detector: el modelo y el tracker son compartidos
+        with self.lock:
+            return self._detect_and_track(
+                video_path,
+                line_position,
+                line_position_x,
+                line_orientation,
+                process_every_n_frames,
+                progress_callback,
+                batch_size,
+                hw_encode,
+                skip_empty_frames,
+                cancel_event,
+                self.conf_threshold if conf_threshold is None else conf_threshold,
+            )
+
+    def _detect_and_track(
+        self,
+        video_path: str,
+        line_position: float,
+        line_position_x: float,
+        line_orientation: str,
+        process_every_n_frames: int,
+        progress_callback,
+        batch_size: Optional[int],
+        hw_encode: bool,
+        skip_empty_frames: bool,
+        cancel_event: Optional[threading.Event],
+        conf_threshold: float
+    ) -> Tuple[str, Dict]:
+        """Implementación de detect_and_track; se ejecuta con self.lock tomado"""
+        if batch_size is None:
+            batch_size = self.DEFAULT_BATCH_SIZE if torch.cuda.is_available() else 1
+        if batch_size < 1:
+            raise ValueError(f"batch_size debe ser >= 1 (recibido: {batch_size})")
+        if self.max_batch_size and batch_size > self.max_batch_size:
+            logger.warning(
+                f"⚠️ El motor TensorRT admite lotes de hasta {self.max_batch_size} frames. "
+                f"Usando batch_size={self.max_batch_size} (solicitado: {batch_size})"
+            )
+            batch_size = self.max_batch_size
+
+        cap = VideoReader(video_path)
         
         if not cap.isOpened():
             raise ValueError(f"No se puede abrir el video: {video_path}")
         
         # Propiedades del video
-        fps = int(cap.get(cv2.CAP_PROP_FPS))
-        width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-        height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-        total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        fps = cap.fps
+        width = cap.width
+        height = cap.height
+        total_frames = cap.total_frames
 
-        # Líneas de conteo
+        # Líneas de conteo: coordenadas en píxeles y líneas activas, calculadas
+        # una sola vez (son fijas durante todo el video)
         line_y = int(height * line_position)  # Línea horizontal
         line_x = int(width * line_position_x)  # Línea vertical
+        line_flags = self.LINE_ORIENTATIONS.get(line_orientation, self.LINE_H | self.LINE_V)
+        use_line_h = bool(line_flags & self.LINE_H)
+        use_line_v = bool(line_flags & self.LINE_V)
+
+        # Las líneas y sus etiquetas son fijas: se dibujan una sola vez y en
+        # cada frame solo se copian sus píxeles
+        overlay_pixels, overlay_colors = self._render_line_overlay(
+            width, height, line_x, line_y, use_line_h, use_line_v
+        )
+
+        # Solo se escriben los frames procesados, a menor FPS para conservar
+        # la duración del video
+        output_fps = fps / process_every_n_frames
+
+        # Encoder H.264 por hardware (NVENC/VAAPI) si se solicitó y está disponible;
+        # si no, libx264 en CPU
+        encoder = find_hw_h264_encoder() if hw_encode else None
+        if hw_encode and encoder is None:
+            logger.warning("⚠️ No hay encoder H.264 por hardware disponible. Usando libx264.")
+        if encoder is None and shutil.which('ffmpeg'):
+            encoder = 'libx264'
 
-        # Video de salida temporal - usar mp4v (compatible con OpenCV)
-        # Nota: Este video será convertido a H.264 con FFmpeg al final para
-        # compatibilidad con navegadores web y Streamlit Cloud
-        output_path = video_path.replace('.mp4', '_processed.mp4')
-
-        # Usar mp4v como codec temporal (será convertido a H.264 después)
-        fourcc = cv2.VideoWriter_fourcc(*'mp4v')
-        out = cv2.VideoWriter(output_path, fourcc, fps, (width, height))
-
-        # Verificar que se haya creado correctamente
-        if not out.isOpened():
-            logger.error("❌ No se pudo crear el VideoWriter con codec mp4v")
-            # Intentar con MJPG como alternativa
-            logger.warning("⚠️ Intentando con codec MJPEG...")
-            fourcc = cv2.VideoWriter_fourcc(*'MJPG')
-            out = cv2.VideoWriter(output_path, fourcc, fps, (width, height))
-            if not out.isOpened():
+        out = None
+        if encoder:
+            # Los frames anotados van directo a FFmpeg: un único encode a H.264
+            # sin archivo intermedio
+            output_path = video_path.replace('.mp4', '_processed_h264.mp4')
+            try:
+                out = FFmpegWriter(output_path, output_fps, (width, height), encoder)
+                logger.info(f"✅ Codificando directamente a H.264 con {encoder}")
+            except OSError as e:
+                logger.warning(f"⚠️ No se pudo iniciar FFmpeg ({e}). Usando OpenCV.")
+                encoder = None
+
+        if out is None:
+            # Sin FFmpegWriter, OpenCV escribe el video. Si FFmpeg está disponible,
+            # convert_video_to_h264 lo convertirá al final, así que se usa MJPEG
+            # (solo intra-frame: la conversión lo decodifica muy rápido). Si no,
+            # mp4v, que queda como video final.
+            codecs = [('MJPG', '.avi'), ('mp4v', '.mp4')]
+            if not shutil.which('ffmpeg'):
+                codecs.reverse()
+
+            for codec, extension in codecs:
+                output_path = video_path.replace('.mp4', f'_processed{extension}')
+                fourcc = cv2.VideoWriter_fourcc(*codec)
+                out = cv2.VideoWriter(output_path, fourcc, output_fps, (width, height))
+                if out.isOpened():
+                    break
+                logger.warning(f"⚠️ No se pudo crear el VideoWriter con codec {codec}")
+            else:
                 raise ValueError("Error al crear el archivo de video de salida")
 
-        logger.info(f"✅ VideoWriter creado con OpenCV (será convertido a H.264)")
+            logger.info(f"✅ VideoWriter creado con OpenCV ({codec})")
 
-        # Tracking de objetos que cruzaron las líneas
-        # Para línea horizontal
-        tracked_ids_up = set()    # IDs que cruzaron hacia arriba
-        tracked_ids_down = set()  # IDs que cruzaron hacia abajo
-        # Para línea vertical
-        tracked_ids_left = set()   # IDs que cruzaron hacia la izquierda
-        tracked_ids_right = set()  # IDs que cruzaron hacia la derecha
-        previous_positions = {}    # {track_id: (x, y)}
+        # Tracking de objetos que cruzaron las líneas. Los IDs de BoT-SORT son
+        # enteros pequeños y consecutivos, así que el estado se guarda en arrays
+        # indexados por track_id (se amplían si aparece un ID mayor)
+        track_capacity = self.TRACK_CAPACITY
+        prev_xy = np.zeros((track_capacity, 2), dtype=np.int32)  # centro previo de cada track
+        has_prev = np.zeros(track_capacity, dtype=bool)           # el track tiene posición previa
+        crossed_ids = np.zeros((4, track_capacity), dtype=bool)   # [UP/DOWN/LEFT/RIGHT, track_id]
+        direction_counts = [0, 0, 0, 0]  # IDs contados por sentido, actualizado en cada cruce
+        unique_count = 0                 # IDs contados en al menos un sentido
+        overlay_counters = None          # contadores con los que se renderizó el texto
+
+        # Reglas de cruce: (eje, sentido, fila de crossed_ids, descripción)
+        # eje 0 = x (línea vertical), eje 1 = y (línea horizontal);
+        # sentido -1 = hacia coordenadas menores, +1 = hacia coordenadas mayores
+        crossing_rules = []
+        if use_line_h:
+            crossing_rules += [
+                (1, -1, self.UP, "ARRIBA (línea horizontal)"),
+                (1, 1, self.DOWN, "ABAJO (línea horizontal)"),
+            ]
+        if use_line_v:
+            crossing_rules += [
+                (0, -1, self.LEFT, "IZQUIERDA (línea vertical)"),
+                (0, 1, self.RIGHT, "DERECHA (línea vertical)"),
+            ]
+        line_coords = np.array([line_x, line_y], dtype=np.int32)
+        rules_array = np.array([rule[:3] for rule in crossing_rules], dtype=np.int64).reshape(-1, 3)
         
-        frame_count = 0
         processed_frames = 0
+        output_frames = 0
+        log_progress = logger.isEnabledFor(logging.INFO)
+        last_frame_empty = False
         
         logger.info(f"Procesando video: {total_frames} frames @ {fps} FPS")
         logger.info(f"Detectando clases: {self.detection_classes} (1=bicycle" + (", 0=person" if self.detect_persons else "") + ")")
-        logger.info(f"Umbral de confianza: {self.conf_threshold}")
+        logger.info(f"Umbral de confianza: {conf_threshold}")
+        logger.info(f"Tamaño de lote: {batch_size}")
         
+        self._reset_tracker()
+
         # Callback inicial
         if progress_callback:
             progress_callback(0, "Iniciando procesamiento...")
         
-        while True:
-            ret, frame = cap.read()
-            if not ret:
-                break
-            
-            frame_count += 1
-            
-            # Procesar cada N frames para velocidad
-            if frame_count % process_every_n_frames != 0:
-                out.write(frame)
-                continue
-            
-            processed_frames += 1
-            
-            # Detección y tracking con BoT-SORT
-            results = self.model.track(
-                frame,
-                persist=True,
-                conf=self.conf_threshold,
-                classes=self.detection_classes,  # Solo bicycle por defecto, o person+bicycle si se habilita
-                tracker="botsort.yaml",
-                verbose=False
-            )
-            
-            # Callback de progreso mejorado (actualiza más frecuentemente)
-            if progress_callback and processed_frames % 5 == 0:
-                progress_percent = int((frame_count / total_frames) * 100)
-                elapsed_time = (frame_count / fps) if fps > 0 else 0
-                frames_per_sec = frame_count / max(elapsed_time, 0.1)
-
-                # Calcular total detectados según orientación
-                if line_orientation == "horizontal":
-                    total_detected = len(tracked_ids_up) + len(tracked_ids_down)
-                    status_msg = f"Frame {frame_count}/{total_frames} ({progress_percent}%) | Detectados: {total_detected} | FPS: {frames_per_sec:.1f}"
-                elif line_orientation == "vertical":
-                    total_detected = len(tracked_ids_left) + len(tracked_ids_right)
-                    status_msg = f"Frame {frame_count}/{total_frames} ({progress_percent}%) | Detectados: {total_detected} | FPS: {frames_per_sec:.1f}"
-                else:  # both
-                    total_h = len(tracked_ids_up) + len(tracked_ids_down)
-                    total_v = len(tracked_ids_left) + len(tracked_ids_right)
-                    status_msg = f"Frame {frame_count}/{total_frames} ({progress_percent}%) | H:{total_h} V:{total_v} | FPS: {frames_per_sec:.1f}"
-
-                progress_callback(progress_percent, status_msg)
-            
-            # Dibujar línea(s) de conteo según orientación
-            if line_orientation in ["horizontal", "both"]:
-                cv2.line(frame, (0, line_y), (width, line_y), (0, 255, 255), 3)
-                cv2.putText(
-                    frame,
-                    "LINEA HORIZONTAL",
-                    (10, line_y - 10),
-                    cv2.FONT_HERSHEY_SIMPLEX,
-                    0.6,
-                    (0, 255, 255),
-                    2
-                )
+        # Lote pendiente de inferencia
+        batch = []  # (frame_idx, frame)
+        video_ended = False
+        pending_progress = None
 
-            if line_orientation in ["vertical", "both"]:
-                cv2.line(frame, (line_x, 0), (line_x, height), (255, 0, 255), 3)
-                cv2.putText(
-                    frame,
-                    "LINEA VERTICAL",
-                    (line_x + 10, 30),
-                    cv2.FONT_HERSHEY_SIMPLEX,
-                    0.6,
-                    (255, 0, 255),
-                    2
+        # Pipeline de tres etapas: un hilo decodifica, este hilo infiere y
+        # anota (el tracker es secuencial), y otro hilo codifica la salida.
+        # La cola de lectura admite al menos dos lotes completos para que el
+        # siguiente lote ya esté decodificado mientras la GPU procesa el actual.
+        read_queue_size = max(PIPELINE_QUEUE_SIZE, 2 * batch_size)
+        frame_queue = queue.Queue(maxsize=read_queue_size)  # (frame_idx, frame); None = fin
+        write_queue = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)  # (frame, progreso); None = fin
+        stop_event = threading.Event()
+        errors = []
+        reader = threading.Thread(target=_read_frames, args=(cap, frame_queue, stop_event, errors, process_every_n_frames), daemon=True)
+        writer = threading.Thread(
+            target=_write_frames, args=(out, write_queue, progress_callback, stop_event, errors), daemon=True
+        )
+        reader.start()
+        writer.start()
+
+        try:
+            while not video_ended:
+                if cancel_event is not None and cancel_event.is_set():
+                    raise InterruptedError("Procesamiento cancelado")
+
+                item = _get_unless_stopped(frame_queue, stop_event)
+                if item is not None:
+                    batch.append(item)
+                    if len(batch) < batch_size:
+                        continue
+                else:
+                    video_ended = True
+                    if not batch:
+                        break
+
+                # Detección y tracking con BoT-SORT: una sola llamada por lote.
+                # El tracker (persist=True) se actualiza secuencialmente frame a frame.
+                batch_results = self.model.track(
+                    [frame for _, frame in batch],
+                    persist=True,
+                    conf=conf_threshold,
+                    classes=self.detection_classes,  # Solo bicycle por defecto, o person+bicycle si se habilita
+                    tracker="botsort.yaml",
+                    imgsz=self.IMGSZ,
+                    half=self.half,
+                    verbose=False
                 )
-            
-            # Procesar detecciones
-            if results[0].boxes.id is not None:
-                boxes = results[0].boxes.xyxy.cpu().numpy()
-                track_ids = results[0].boxes.id.cpu().numpy().astype(int)
-                confidences = results[0].boxes.conf.cpu().numpy()
-                classes = results[0].boxes.cls.cpu().numpy().astype(int)
-                
-                # Log para debugging (solo primeras detecciones)
-                if processed_frames == 1:
-                    logger.info(f"✅ Primera detección: {len(boxes)} objetos encontrados")
-                    for i, cls in enumerate(classes):
-                        cls_name = "person" if cls == 0 else "bicycle"
-                        logger.info(f"   Objeto {i+1}: {cls_name} (confianza: {confidences[i]:.2f})")
+                current_batch, batch = batch, []
+
+                for (frame_idx, frame), result in zip(current_batch, batch_results):
+                    processed_frames += 1
+                    last_frame_empty = result.boxes.id is None
+
+                    # Callback de progreso mejorado (actualiza más frecuentemente)
+                    if progress_callback and processed_frames % 5 == 0:
+                        progress_percent = int((frame_idx / total_frames) * 100)
+                        elapsed_time = (frame_idx / fps) if fps > 0 else 0
+                        frames_per_sec = frame_idx / max(elapsed_time, 0.1)
+                        n_up, n_down, n_left, n_right = direction_counts
+
+                        # Calcular total detectados según orientación
+                        if line_flags == self.LINE_H:
+                            total_detected = n_up + n_down
+                            status_msg = f"Frame {frame_idx}/{total_frames} ({progress_percent}%) | Detectados: {total_detected} | FPS: {frames_per_sec:.1f}"
+                        elif line_flags == self.LINE_V:
+                            total_detected = n_left + n_right
+                            status_msg = f"Frame {frame_idx}/{total_frames} ({progress_percent}%) | Detectados: {total_detected} | FPS: {frames_per_sec:.1f}"
+                        else:  # both
+                            total_h = n_up + n_down
+                            total_v = n_left + n_right
+                            status_msg = f"Frame {frame_idx}/{total_frames} ({progress_percent}%) | H:{total_h} V:{total_v} | FPS: {frames_per_sec:.1f}"
+
+                        pending_progress = (progress_percent, status_msg)
+
+                    # Sin detecciones: no se dibuja ni se codifica el frame.
+                    # El primero siempre se escribe para que el video no quede vacío.
+                    if skip_empty_frames and last_frame_empty and output_frames:
+                        continue
+
+                    # Dibujar línea(s) de conteo según orientación
+                    frame[overlay_pixels] = overlay_colors
+
+                    # Procesar detecciones
+                    if result.boxes.id is not None:
+                        # Los centros se calculan en el dispositivo del modelo y viajan
+                        # en la misma copia GPU->CPU que las cajas. Con tracking las
+                        # columnas son (x1, y1, x2, y2, id, conf, cls) + (cx, cy)
+                        data = result.boxes.data
+                        det = torch.cat((data, (data[:, :2] + data[:, 2:4]) / 2), dim=1).cpu().numpy()
+                        boxes = det[:, :4]
+                        track_ids = det[:, 4].astype(int)
+                        confidences = det[:, 5]
+                        classes = det[:, 6].astype(int)
+                        centers = det[:, 7:9].astype(np.int32)  # (N, 2)
                 
-                for box, track_id, conf, cls in zip(boxes, track_ids, confidences, classes):
-                    x1, y1, x2, y2 = box
-                    cx = int((x1 + x2) / 2)  # Centro X
-                    cy = int((y1 + y2) / 2)  # Centro Y
-
-                    # Verificar cruce de línea(s)
-                    if track_id in previous_positions:
-                        prev_cx, prev_cy = previous_positions[track_id]
-
-                        # Verificar cruce de línea HORIZONTAL
-                        if line_orientation in ["horizontal", "both"]:
-                            # Cruce hacia arriba
-                            if prev_cy > line_y and cy <= line_y:
-                                if track_id not in tracked_ids_up:
-                                    tracked_ids_up.add(track_id)
-                                    logger.info(f"🚴 Ciclista #{track_id} cruzó ARRIBA (línea horizontal)")
-
-                            # Cruce hacia abajo
-                            elif prev_cy < line_y and cy >= line_y:
-                                if track_id not in tracked_ids_down:
-                                    tracked_ids_down.add(track_id)
-                                    logger.info(f"🚴 Ciclista #{track_id} cruzó ABAJO (línea horizontal)")
-
-                        # Verificar cruce de línea VERTICAL
-                        if line_orientation in ["vertical", "both"]:
-                            # Cruce hacia la izquierda
-                            if prev_cx > line_x and cx <= line_x:
-                                if track_id not in tracked_ids_left:
-                                    tracked_ids_left.add(track_id)
-                                    logger.info(f"🚴 Ciclista #{track_id} cruzó IZQUIERDA (línea vertical)")
-
-                            # Cruce hacia la derecha
-                            elif prev_cx < line_x and cx >= line_x:
-                                if track_id not in tracked_ids_right:
-                                    tracked_ids_right.add(track_id)
-                                    logger.info(f"🚴 Ciclista #{track_id} cruzó DERECHA (línea vertical)")
-
-                    # Actualizar posición
-                    previous_positions[track_id] = (cx, cy)
-                    
-                    # Dibujar bounding box
-                    color = (0, 255, 0)
-                    cv2.rectangle(frame, (int(x1), int(y1)), (int(x2), int(y2)), color, 2)
-                    
-                    # Label
-                    label = f"ID:{track_id} {conf:.2f}"
+                        # Log para debugging (solo primeras detecciones)
+                        if processed_frames == 1:
+                            logger.info(f"✅ Primera detección: {len(boxes)} objetos encontrados")
+                            for i, cls in enumerate(classes):
+                                cls_name = "person" if cls == 0 else "bicycle"
+                                logger.info(f"   Objeto {i+1}: {cls_name} (confianza: {confidences[i]:.2f})")
+
+                        # Ampliar los arrays de estado si aparece un ID fuera de rango
+                        max_id = int(track_ids.max())
+                        if max_id >= track_capacity:
+                            grow = max(track_capacity, max_id + 1 - track_capacity)
+                            track_capacity += grow
+                            prev_xy = np.pad(prev_xy, ((0, grow), (0, 0)))
+                            has_prev = np.pad(has_prev, (0, grow))
+                            crossed_ids = np.pad(crossed_ids, ((0, 0), (0, grow)))
+
+                        # Verificar cruce de línea(s) y actualizar posiciones (Numba)
+                        events, new_unique = update_crossings(
+                            track_ids, centers, prev_xy, has_prev, crossed_ids, line_coords, rules_array
+                        )
+                        unique_count += new_unique
+                        for rule_index, track_id in events.tolist():
+                            _, _, row, description = crossing_rules[rule_index]
+                            direction_counts[row] += 1
+                            logger.info(f"🚴 Ciclista #{track_id} cruzó {description}")
+
+                        # Dibujar todas las cajas en una sola llamada: cada caja
+                        # (x1, y1, x2, y2) se convierte en un cuadrilátero cerrado
+                        boxes_i = boxes.astype(np.int32)
+                        quads = boxes_i[:, [0, 1, 2, 1, 2, 3, 0, 3]].reshape(-1, 4, 2)
+                        cv2.polylines(frame, list(quads), True, self.BOX_COLOR, 2)
+
+                        # Labels y puntos centrales (OpenCV no tiene versión por lotes)
+                        for (x1, y1), track_id, conf, center in zip(boxes_i[:, :2].tolist(), track_ids.tolist(), confidences, centers.tolist()):
+                            cv2.putText(
+                                frame,
+                                f"ID:{track_id} {conf:.2f}",
+                                (x1, y1 - 10),
+                                cv2.FONT_HERSHEY_SIMPLEX,
+                                0.6,
+                                self.BOX_COLOR,
+                                2
+                            )
+                            cv2.circle(frame, tuple(center), 5, (0, 0, 255), -1)
+            
+                    # Mostrar contadores según orientación. Solo cambian cuando hay
+                    # un cruce: el texto se rasteriza entonces y en cada frame se
+                    # mezcla la capa ya renderizada
+                    counters = (*direction_counts, unique_count)
+                    if counters != overlay_counters:
+                        overlay_counters = counters
+                        n_up, n_down, n_left, n_right = direction_counts
+
+                        if line_flags == self.LINE_H:
+                            total_count = n_up + n_down
+                            info_text = [
+                                f"Total: {total_count}",
+                                f"Arriba: {n_up}",
+                                f"Abajo: {n_down}",
+                            ]
+                        elif line_flags == self.LINE_V:
+                            total_count = n_left + n_right
+                            info_text = [
+                                f"Total: {total_count}",
+                                f"Izquierda: {n_left}",
+                                f"Derecha: {n_right}",
+                            ]
+                        else:  # both
+                            total_h = n_up + n_down
+                            total_v = n_left + n_right
+                            info_text = [
+                                f"Horizontal: {total_h} (Arr:{n_up} Aba:{n_down})",
+                                f"Vertical: {total_v} (Izq:{n_left} Der:{n_right})",
+                                f"Total Unico: {unique_count}",
+                            ]
+
+                        counter_rect, counter_alpha = self._render_text_overlay(info_text, width, height)
+
+                    self._blend_text_overlay(frame, counter_rect, counter_alpha)
+
+                    # El número de frame cambia siempre: se dibuja directamente
                     cv2.putText(
                         frame,
-                        label,
-                        (int(x1), int(y1) - 10),
+                        f"Frame: {frame_idx}/{total_frames}",
+                        (10, 30 + len(info_text) * 30),
                         cv2.FONT_HERSHEY_SIMPLEX,
-                        0.6,
-                        color,
-                        2
+                        0.7,
+                        (255, 255, 255),
+                        2,
+                        cv2.LINE_AA
                     )
-                    
-                    # Punto central
-                    cv2.circle(frame, (cx, cy), 5, (0, 0, 255), -1)
-            
-            # Mostrar contadores según orientación
-            info_text = []
-
-            if line_orientation == "horizontal":
-                total_count = len(tracked_ids_up) + len(tracked_ids_down)
-                info_text = [
-                    f"Total: {total_count}",
-                    f"Arriba: {len(tracked_ids_up)}",
-                    f"Abajo: {len(tracked_ids_down)}",
-                    f"Frame: {frame_count}/{total_frames}"
-                ]
-            elif line_orientation == "vertical":
-                total_count = len(tracked_ids_left) + len(tracked_ids_right)
-                info_text = [
-                    f"Total: {total_count}",
-                    f"Izquierda: {len(tracked_ids_left)}",
-                    f"Derecha: {len(tracked_ids_right)}",
-                    f"Frame: {frame_count}/{total_frames}"
-                ]
-            else:  # both
-                total_h = len(tracked_ids_up) + len(tracked_ids_down)
-                total_v = len(tracked_ids_left) + len(tracked_ids_right)
-                info_text = [
-                    f"Horizontal: {total_h} (Arr:{len(tracked_ids_up)} Aba:{len(tracked_ids_down)})",
-                    f"Vertical: {total_v} (Izq:{len(tracked_ids_left)} Der:{len(tracked_ids_right)})",
-                    f"Total Unico: {len(set(list(tracked_ids_up) + list(tracked_ids_down) + list(tracked_ids_left) + list(tracked_ids_right)))}",
-                    f"Frame: {frame_count}/{total_frames}"
-                ]
-
-            y_offset = 30
-            for i, text in enumerate(info_text):
-                cv2.putText(
-                    frame,
-                    text,
-                    (10, y_offset + i * 30),
-                    cv2.FONT_HERSHEY_SIMPLEX,
-                    0.7,
-                    (255, 255, 255),
-                    2,
-                    cv2.LINE_AA
-                )
-            
-            out.write(frame)
-            
-            # Progress
-            if processed_frames % 30 == 0:
-                progress = (frame_count / total_frames) * 100
-                logger.info(f"Progreso: {progress:.1f}%")
-        
-        cap.release()
-        out.release()
+
+                    # El hilo escritor reporta el progreso tras codificar el frame
+                    _put_unless_stopped(write_queue, (frame, pending_progress), stop_event)
+                    pending_progress = None
+                    output_frames += 1
+
+                    # Progress
+                    if processed_frames % 30 == 0 and log_progress:
+                        progress = (frame_idx / total_frames) * 100
+                        logger.info(f"Progreso: {progress:.1f}%")
+
+            # Esperar a que el escritor vacíe la cola
+            _put_unless_stopped(write_queue, None, stop_event)
+            writer.join()
+        finally:
+            stop_event.set()
+            reader.join()
+            writer.join()
+            cap.release()
+            out.release()
+
+        if errors:
+            raise errors[0]
+
+        # Con FFmpegWriter el código de salida de FFmpeg ya valida el video
+        if isinstance(out, FFmpegWriter) and out.returncode != 0:
+            raise ValueError(f"FFmpeg no pudo codificar el video procesado (código {out.returncode})")
 
         # Asegurar que el archivo se haya escrito correctamente
         if not os.path.exists(output_path):
@@ -432,17 +1352,10 @@ class CyclistDetector:
 
         logger.info(f"✅ Video procesado guardado: {output_path} ({file_size / (1024*1024):.2f} MB)")
 
-        # Validar que el video se puede leer correctamente
-        try:
-            test_cap = cv2.VideoCapture(output_path)
-            if not test_cap.isOpened():
-                logger.warning("⚠️ El video generado no se puede abrir, pero el archivo existe")
-            else:
-                test_frames = int(test_cap.get(cv2.CAP_PROP_FRAME_COUNT))
-                logger.info(f"✅ Video validado: {test_frames} frames")
-                test_cap.release()
-        except Exception as e:
-            logger.warning(f"⚠️ No se pudo validar el video: {e}")
+        # Validar que el video se puede leer (abre y decodifica la cabecera del
+        # archivo recién escrito: solo en modo debug)
+        if logger.isEnabledFor(logging.DEBUG):
+            self._probe_output(output_path)
 
         # Callback final
         if progress_callback:
@@ -453,23 +1366,23 @@ class CyclistDetector:
         duration_minutes = duration_seconds / 60
 
         # Calcular totales según orientación de línea
-        if line_orientation == "horizontal":
-            total_cyclists = len(tracked_ids_up) + len(tracked_ids_down)
-        elif line_orientation == "vertical":
-            total_cyclists = len(tracked_ids_left) + len(tracked_ids_right)
+        n_up, n_down, n_left, n_right = direction_counts
+        if line_flags == self.LINE_H:
+            total_cyclists = n_up + n_down
+        elif line_flags == self.LINE_V:
+            total_cyclists = n_left + n_right
         else:  # both - contar IDs únicos
-            all_ids = set(list(tracked_ids_up) + list(tracked_ids_down) + list(tracked_ids_left) + list(tracked_ids_right))
-            total_cyclists = len(all_ids)
+            total_cyclists = unique_count
 
         cyclists_per_minute = total_cyclists / duration_minutes if duration_minutes > 0 else 0
         cyclists_per_hour = cyclists_per_minute * 60
 
         metrics = {
             'total_cyclists': total_cyclists,
-            'cyclists_up': len(tracked_ids_up),
-            'cyclists_down': len(tracked_ids_down),
-            'cyclists_left': len(tracked_ids_left),
-            'cyclists_right': len(tracked_ids_right),
+            'cyclists_up': n_up,
+            'cyclists_down': n_down,
+            'cyclists_left': n_left,
+            'cyclists_right': n_right,
             'cyclists_per_minute': round(cyclists_per_minute, 2),
             'cyclists_per_hour': round(cyclists_per_hour, 2),
             'duration_seconds': round(duration_seconds, 2),
@@ -477,9 +1390,15 @@ class CyclistDetector:
             'fps': fps,
             'total_frames': total_frames,
             'processed_frames': processed_frames,
+            'output_frames': output_frames,
+            'output_fps': round(output_fps, 2),
             'model_used': f"YOLOv11{self.model_size}",
-            'confidence_threshold': self.conf_threshold,
-            'line_orientation': line_orientation
+            'backend': self.backend,
+            'precision': self.precision,
+            'encoder': encoder or f"OpenCV ({codec})",
+            'confidence_threshold': conf_threshold,
+            'line_orientation': line_orientation,
+            'video_info': cap.info
         }
         
         logger.info("=" * 50)
@@ -487,23 +1406,25 @@ class CyclistDetector:
         if total_cyclists == 0:
             logger.warning("⚠️  NO SE DETECTARON CICLISTAS")
             logger.info("💡 Sugerencias:")
-            logger.info("   - Reducir umbral de confianza (actual: {:.2f})".format(self.conf_threshold))
+            logger.info("   - Reducir umbral de confianza (actual: {:.2f})".format(conf_threshold))
             logger.info("   - Verificar que el video contenga ciclistas visibles")
             logger.info("   - Usar modelo Small (más preciso) en vez de Nano")
         else:
             logger.info(f"✅ Total ciclistas: {total_cyclists}")
-            if line_orientation in ["horizontal", "both"]:
-                logger.info(f"↑ Hacia arriba: {len(tracked_ids_up)}")
-                logger.info(f"↓ Hacia abajo: {len(tracked_ids_down)}")
-            if line_orientation in ["vertical", "both"]:
-                logger.info(f"← Hacia izquierda: {len(tracked_ids_left)}")
-                logger.info(f"→ Hacia derecha: {len(tracked_ids_right)}")
+            if use_line_h:
+                logger.info(f"↑ Hacia arriba: {n_up}")
+                logger.info(f"↓ Hacia abajo: {n_down}")
+            if use_line_v:
+                logger.info(f"← Hacia izquierda: {n_left}")
+                logger.info(f"→ Hacia derecha: {n_right}")
             logger.info(f"📊 Ciclistas/minuto: {cyclists_per_minute:.2f}")
             logger.info(f"📊 Ciclistas/hora (proyección): {cyclists_per_hour:.2f}")
         logger.info("=" * 50)
 
         # Convertir video a H.264 para compatibilidad con Streamlit Cloud
-        logger.info("🎬 Convirtiendo video a formato compatible con navegadores web...")
-        output_path = convert_video_to_h264(output_path)
+        # (no hace falta si ya se codificó en H.264 con FFmpegWriter)
+        if not encoder:
+            logger.info("🎬 Convirtiendo video a formato compatible con navegadores web...")
+            output_path = convert_video_to_h264(output_path, use_hw_encoder=hw_encode)
 
         return output_path, metrics
@@ -1,13 +1,74 @@
 """
 Funciones auxiliares para visualización y análisis
 """
+import bisect
+import csv
+import io
+import numpy as np
+from operator import itemgetter
 import plotly.graph_objects as go
-import plotly.express as px
-import pandas as pd
-from typing import Dict
+from typing import Callable, Dict, List, Tuple
 import streamlit as st
 
 
+# Conteos por sentido: arriba, abajo, izquierda, derecha
+DIRECTION_KEYS = ('cyclists_up', 'cyclists_down', 'cyclists_left', 'cyclists_right')
+
+
+def enrich_metrics(metrics: Dict) -> Dict:
+    """
+    Añade a una copia de las métricas la proporción de cada sentido sobre el total
+
+    Se calcula una sola vez por análisis y la reutilizan las funciones que
+    reciben metrics (p. ej. generate_recommendations).
+
+    Args:
+        metrics: Diccionario con métricas
+
+    Returns:
+        Copia de metrics con las claves '<sentido>_ratio' (p. ej. 'cyclists_up_ratio')
+    """
+    enriched = dict(metrics)
+    total = metrics['total_cyclists']
+    counts = np.asarray([metrics[key] for key in DIRECTION_KEYS], dtype=np.float64)
+    ratios = counts / total if total > 0 else np.zeros(len(DIRECTION_KEYS))
+    for key, ratio in zip(DIRECTION_KEYS, ratios.tolist()):
+        enriched[f'{key}_ratio'] = ratio
+    return enriched
+
+
+# Métricas del dashboard: (etiqueta, clave en metrics, formato o None)
+_METRIC_TOTAL = ("🚴 Total Ciclistas", 'total_cyclists', None)
+_METRIC_PER_MINUTE = ("📈 Ciclistas/Minuto", 'cyclists_per_minute', "{:.2f}")
+_METRIC_DURATION = ("⏱️ Duración Video", 'duration_minutes', "{:.1f} min")
+_METRIC_MODEL = ("🎯 Modelo", 'model_used', None)
+_METRIC_UP = ("↑ Hacia Arriba", 'cyclists_up', None)
+_METRIC_DOWN = ("↓ Hacia Abajo", 'cyclists_down', None)
+_METRIC_LEFT = ("← Hacia Izquierda", 'cyclists_left', None)
+_METRIC_RIGHT = ("→ Hacia Derecha", 'cyclists_right', None)
+_METRIC_PER_HOUR = ("📊 Proyección/Hora", 'cyclists_per_hour', "{:.0f}")
+_METRIC_FPS = ("🎬 FPS", 'fps', None)
+
+# Bloques del dashboard según orientación de línea: (encabezado o None, filas).
+# Las filas de un bloque comparten una sola grilla de st.columns; cada
+# columna apila una métrica por fila
+_GENERAL_ROW = [_METRIC_TOTAL, _METRIC_PER_MINUTE, _METRIC_DURATION, _METRIC_MODEL]
+METRIC_LAYOUTS = {
+    "horizontal": [
+        (None, [_GENERAL_ROW, [_METRIC_UP, _METRIC_DOWN, _METRIC_PER_HOUR, _METRIC_FPS]]),
+    ],
+    "vertical": [
+        (None, [_GENERAL_ROW, [_METRIC_LEFT, _METRIC_RIGHT, _METRIC_PER_HOUR, _METRIC_FPS]]),
+    ],
+    "both": [
+        (None, [_GENERAL_ROW]),
+        ("#### Dirección Horizontal", [[_METRIC_UP, _METRIC_DOWN]]),
+        ("#### Dirección Vertical", [[_METRIC_LEFT, _METRIC_RIGHT]]),
+        ("#### Métricas Generales", [[_METRIC_PER_HOUR, _METRIC_FPS]]),
+    ],
+}
+
+
 def create_metrics_dashboard(metrics: Dict) -> None:
     """
     Crea dashboard de métricas con Streamlit
@@ -19,133 +80,92 @@ def create_metrics_dashboard(metrics: Dict) -> None:
 
     line_orientation = metrics.get('line_orientation', 'horizontal')
 
-    # Métricas principales en columnas
-    col1, col2, col3, col4 = st.columns(4)
-
-    with col1:
-        st.metric(
-            label="🚴 Total Ciclistas",
-            value=metrics['total_cyclists']
-        )
-
-    with col2:
-        st.metric(
-            label="📈 Ciclistas/Minuto",
-            value=f"{metrics['cyclists_per_minute']:.2f}"
-        )
+    for header, rows in METRIC_LAYOUTS.get(line_orientation, METRIC_LAYOUTS["both"]):
+        if header:
+            st.markdown(header)
+        cols = st.columns(len(rows[0]))
+        for row in rows:
+            for col, (label, key, fmt) in zip(cols, row):
+                col.metric(label=label, value=fmt.format(metrics[key]) if fmt else metrics[key])
+
+
+# Layout común de los gráficos (fondo transparente para heredar el tema de Streamlit)
+_BAR_LAYOUT_BASE = {
+    'height': 400,
+    'showlegend': False,
+    'plot_bgcolor': 'rgba(0,0,0,0)',
+    'paper_bgcolor': 'rgba(0,0,0,0)',
+}
+_GAUGE_LAYOUT = {
+    'height': 300,
+    'margin': {'l': 20, 'r': 20, 't': 80, 'b': 20},
+    'paper_bgcolor': 'rgba(0,0,0,0)',
+}
+
+# Niveles de flujo (bajo, medio, alto) según ciclistas/hora, compartidos por
+# el gauge y las recomendaciones
+_FLOW_THRESHOLDS = (50, 150)
+_FLOW_COLORS = ("#EF553B", "#FFA15A", "#00CC96")  # Rojo, naranja, verde
+_FLOW_CATEGORIES = ("Bajo Flujo", "Flujo Medio", "Alto Flujo")
+
+# Gráfico de dirección según orientación de línea:
+# (etiquetas, colores, título, índices en (arriba, abajo, izquierda, derecha))
+_DIRECTION_CHARTS = {
+    "horizontal": (
+        ('Hacia Arriba ↑', 'Hacia Abajo ↓'),
+        ('#00CC96', '#EF553B'),
+        "Distribución por Dirección (Línea Horizontal)",
+        (0, 1),
+    ),
+    "vertical": (
+        ('Hacia Izquierda ←', 'Hacia Derecha →'),
+        ('#636EFA', '#AB63FA'),
+        "Distribución por Dirección (Línea Vertical)",
+        (2, 3),
+    ),
+    "both": (
+        ('Arriba ↑', 'Abajo ↓', 'Izquierda ←', 'Derecha →'),
+        ('#00CC96', '#EF553B', '#636EFA', '#AB63FA'),
+        "Distribución por Dirección (Todas)",
+        (0, 1, 2, 3),
+    ),
+}
+
+
+def _bar_chart(x, y, colors, title: str, xaxis_title: str, yaxis_title: str, text=None) -> go.Figure:
+    """
+    Construye un gráfico de barras con el layout común
 
-    with col3:
-        st.metric(
-            label="⏱️ Duración Video",
-            value=f"{metrics['duration_minutes']:.1f} min"
-        )
+    Args:
+        x: Etiquetas de las barras
+        y: Valores de las barras
+        colors: Color de cada barra
+        title: Título del gráfico
+        xaxis_title: Título del eje X
+        yaxis_title: Título del eje Y
+        text: Texto sobre cada barra (por defecto, los valores)
 
-    with col4:
-        st.metric(
-            label="🎯 Modelo",
-            value=metrics['model_used']
+    Returns:
+        Figura de Plotly
+    """
+    fig = go.Figure(data=[
+        go.Bar(
+            x=x,
+            y=y,
+            marker_color=colors,
+            text=y if text is None else text,
+            textposition='auto',
         )
+    ])
 
-    # Segunda fila de métricas - Direcciones según orientación de línea
-    if line_orientation == "horizontal":
-        col5, col6, col7, col8 = st.columns(4)
-
-        with col5:
-            st.metric(
-                label="↑ Hacia Arriba",
-                value=metrics['cyclists_up']
-            )
-
-        with col6:
-            st.metric(
-                label="↓ Hacia Abajo",
-                value=metrics['cyclists_down']
-            )
-
-        with col7:
-            st.metric(
-                label="📊 Proyección/Hora",
-                value=f"{metrics['cyclists_per_hour']:.0f}"
-            )
-
-        with col8:
-            st.metric(
-                label="🎬 FPS",
-                value=metrics['fps']
-            )
-
-    elif line_orientation == "vertical":
-        col5, col6, col7, col8 = st.columns(4)
-
-        with col5:
-            st.metric(
-                label="← Hacia Izquierda",
-                value=metrics['cyclists_left']
-            )
-
-        with col6:
-            st.metric(
-                label="→ Hacia Derecha",
-                value=metrics['cyclists_right']
-            )
-
-        with col7:
-            st.metric(
-                label="📊 Proyección/Hora",
-                value=f"{metrics['cyclists_per_hour']:.0f}"
-            )
-
-        with col8:
-            st.metric(
-                label="🎬 FPS",
-                value=metrics['fps']
-            )
+    fig.update_layout(
+        title=title,
+        xaxis_title=xaxis_title,
+        yaxis_title=yaxis_title,
+        **_BAR_LAYOUT_BASE,
+    )
 
-    else:  # both
-        st.markdown("#### Dirección Horizontal")
-        col5, col6 = st.columns(2)
-
-        with col5:
-            st.metric(
-                label="↑ Hacia Arriba",
-                value=metrics['cyclists_up']
-            )
-
-        with col6:
-            st.metric(
-                label="↓ Hacia Abajo",
-                value=metrics['cyclists_down']
-            )
-
-        st.markdown("#### Dirección Vertical")
-        col7, col8 = st.columns(2)
-
-        with col7:
-            st.metric(
-                label="← Hacia Izquierda",
-                value=metrics['cyclists_left']
-            )
-
-        with col8:
-            st.metric(
-                label="→ Hacia Derecha",
-                value=metrics['cyclists_right']
-            )
-
-        st.markdown("#### Métricas Generales")
-        col9, col10 = st.columns(2)
-
-        with col9:
-            st.metric(
-                label="📊 Proyección/Hora",
-                value=f"{metrics['cyclists_per_hour']:.0f}"
-            )
-
-        with col10:
-            st.metric(
-                label="🎬 FPS",
-                value=metrics['fps']
-            )
+    return fig
 
 
 def create_direction_chart(metrics: Dict) -> go.Figure:
@@ -158,58 +178,35 @@ def create_direction_chart(metrics: Dict) -> go.Figure:
     Returns:
         Figura de Plotly
     """
-    line_orientation = metrics.get('line_orientation', 'horizontal')
-
-    if line_orientation == "horizontal":
-        data = {
-            'Dirección': ['Hacia Arriba ↑', 'Hacia Abajo ↓'],
-            'Cantidad': [metrics['cyclists_up'], metrics['cyclists_down']],
-            'Color': ['#00CC96', '#EF553B']
-        }
-        title = "Distribución por Dirección (Línea Horizontal)"
+    return _direction_chart(
+        metrics.get('line_orientation', 'horizontal'),
+        metrics['cyclists_up'],
+        metrics['cyclists_down'],
+        metrics['cyclists_left'],
+        metrics['cyclists_right'],
+    )
 
-    elif line_orientation == "vertical":
-        data = {
-            'Dirección': ['Hacia Izquierda ←', 'Hacia Derecha →'],
-            'Cantidad': [metrics['cyclists_left'], metrics['cyclists_right']],
-            'Color': ['#636EFA', '#AB63FA']
-        }
-        title = "Distribución por Dirección (Línea Vertical)"
 
-    else:  # both
-        data = {
-            'Dirección': ['Arriba ↑', 'Abajo ↓', 'Izquierda ←', 'Derecha →'],
-            'Cantidad': [
-                metrics['cyclists_up'],
-                metrics['cyclists_down'],
-                metrics['cyclists_left'],
-                metrics['cyclists_right']
-            ],
-            'Color': ['#00CC96', '#EF553B', '#636EFA', '#AB63FA']
-        }
-        title = "Distribución por Dirección (Todas)"
+@st.cache_data(max_entries=32, show_spinner=False)
+def _direction_chart(line_orientation: str, up: int, down: int, left: int, right: int) -> go.Figure:
+    """
+    Construye el gráfico de dirección; se memoiza por conteos para no rehacerlo en cada rerun
 
-    fig = go.Figure(data=[
-        go.Bar(
-            x=data['Dirección'],
-            y=data['Cantidad'],
-            marker_color=data['Color'],
-            text=data['Cantidad'],
-            textposition='auto',
-        )
-    ])
+    Args:
+        line_orientation: Orientación de la línea ('horizontal', 'vertical' o 'both')
+        up: Ciclistas hacia arriba
+        down: Ciclistas hacia abajo
+        left: Ciclistas hacia la izquierda
+        right: Ciclistas hacia la derecha
 
-    fig.update_layout(
-        title=title,
-        xaxis_title="Dirección",
-        yaxis_title="Número de Ciclistas",
-        height=400,
-        showlegend=False,
-        plot_bgcolor='rgba(0,0,0,0)',
-        paper_bgcolor='rgba(0,0,0,0)',
-    )
+    Returns:
+        Figura de Plotly
+    """
+    labels, colors, title, indices = _DIRECTION_CHARTS.get(line_orientation, _DIRECTION_CHARTS["both"])
+    all_counts = (up, down, left, right)
+    counts = [all_counts[i] for i in indices]
 
-    return fig
+    return _bar_chart(labels, counts, colors, title, "Dirección", "Número de Ciclistas")
 
 
 def create_flow_gauge(metrics: Dict) -> go.Figure:
@@ -222,18 +219,24 @@ def create_flow_gauge(metrics: Dict) -> go.Figure:
     Returns:
         Figura de Plotly con gauge
     """
-    cyclists_per_hour = metrics['cyclists_per_hour']
-    
+    return _flow_gauge(metrics['cyclists_per_hour'])
+
+
+@st.cache_data(max_entries=32, show_spinner=False)
+def _flow_gauge(cyclists_per_hour: float) -> go.Figure:
+    """
+    Construye el gauge de flujo; se memoiza por ciclistas/hora
+
+    Args:
+        cyclists_per_hour: Flujo proyectado de ciclistas por hora
+
+    Returns:
+        Figura de Plotly con gauge
+    """
     # Determinar color basado en flujo
-    if cyclists_per_hour < 50:
-        color = "#EF553B"  # Rojo - Bajo flujo
-        category = "Bajo Flujo"
-    elif cyclists_per_hour < 150:
-        color = "#FFA15A"  # Naranja - Flujo medio
-        category = "Flujo Medio"
-    else:
-        color = "#00CC96"  # Verde - Alto flujo
-        category = "Alto Flujo"
+    flow_level = bisect.bisect_right(_FLOW_THRESHOLDS, cyclists_per_hour)
+    color, category = _FLOW_COLORS[flow_level], _FLOW_CATEGORIES[flow_level]
+    low, high = _FLOW_THRESHOLDS
     
     fig = go.Figure(go.Indicator(
         mode="gauge+number+delta",
@@ -245,23 +248,19 @@ def create_flow_gauge(metrics: Dict) -> go.Figure:
             'axis': {'range': [None, 300]},
             'bar': {'color': color},
             'steps': [
-                {'range': [0, 50], 'color': "rgba(239, 85, 59, 0.2)"},
-                {'range': [50, 150], 'color': "rgba(255, 161, 90, 0.2)"},
-                {'range': [150, 300], 'color': "rgba(0, 204, 150, 0.2)"}
+                {'range': [0, low], 'color': "rgba(239, 85, 59, 0.2)"},
+                {'range': [low, high], 'color': "rgba(255, 161, 90, 0.2)"},
+                {'range': [high, 300], 'color': "rgba(0, 204, 150, 0.2)"}
             ],
             'threshold': {
                 'line': {'color': "black", 'width': 4},
                 'thickness': 0.75,
-                'value': 150
+                'value': high
             }
         }
     ))
     
-    fig.update_layout(
-        height=300,
-        margin=dict(l=20, r=20, t=80, b=20),
-        paper_bgcolor='rgba(0,0,0,0)',
-    )
+    fig.update_layout(**_GAUGE_LAYOUT)
     
     return fig
 
@@ -276,137 +275,198 @@ def create_comparison_chart(metrics: Dict) -> go.Figure:
     Returns:
         Figura de Plotly
     """
-    data = {
-        'Métrica': ['Por Minuto', 'Por Hora (Proyección)'],
-        'Ciclistas': [
-            metrics['cyclists_per_minute'],
-            metrics['cyclists_per_hour']
-        ]
-    }
-    
-    fig = go.Figure(data=[
-        go.Bar(
-            x=data['Métrica'],
-            y=data['Ciclistas'],
-            marker_color=['#636EFA', '#00CC96'],
-            text=[f"{val:.1f}" for val in data['Ciclistas']],
-            textposition='auto',
-        )
-    ])
-    
-    fig.update_layout(
-        title="Flujo Temporal de Ciclistas",
-        xaxis_title="Período de Tiempo",
-        yaxis_title="Número de Ciclistas",
-        height=400,
-        showlegend=False,
-        plot_bgcolor='rgba(0,0,0,0)',
-        paper_bgcolor='rgba(0,0,0,0)',
-    )
-    
-    return fig
+    return _comparison_chart(metrics['cyclists_per_minute'], metrics['cyclists_per_hour'])
 
 
-def generate_recommendations(metrics: Dict) -> str:
+@st.cache_data(max_entries=32, show_spinner=False)
+def _comparison_chart(cyclists_per_minute: float, cyclists_per_hour: float) -> go.Figure:
     """
-    Genera recomendaciones basadas en métricas
+    Construye el gráfico comparativo; se memoiza por flujo por minuto y por hora
 
     Args:
-        metrics: Diccionario con métricas
+        cyclists_per_minute: Ciclistas por minuto
+        cyclists_per_hour: Proyección de ciclistas por hora
 
     Returns:
-        String con recomendaciones en Markdown
+        Figura de Plotly
     """
-    cyclists_per_hour = metrics['cyclists_per_hour']
-    total = metrics['total_cyclists']
-    line_orientation = metrics.get('line_orientation', 'horizontal')
+    values = [cyclists_per_minute, cyclists_per_hour]
+
+    return _bar_chart(
+        ['Por Minuto', 'Por Hora (Proyección)'],
+        values,
+        ['#636EFA', '#00CC96'],
+        "Flujo Temporal de Ciclistas",
+        "Período de Tiempo",
+        "Número de Ciclistas",
+        text=[f"{val:.1f}" for val in values],
+    )
 
-    recommendations = "### 💡 Recomendaciones para Planificación Urbana\n\n"
 
-    if cyclists_per_hour < 50:
-        recommendations += f"""
-**Flujo Bajo** ({cyclists_per_hour:.0f} ciclistas/hora proyectados)
+# Recomendaciones por nivel de flujo (bajo, medio, alto)
+FLOW_TEMPLATES = (
+    """
+**Flujo Bajo** ({cph:.0f} ciclistas/hora proyectados)
 
 - ⚠️ El flujo de ciclistas es bajo para justificar infraestructura dedicada
 - 📍 Considerar señalización compartida con vehículos
 - 📊 Recopilar datos en diferentes horarios para análisis completo
 - 🎯 Evaluar campañas de promoción de movilidad en bicicleta
-"""
-    elif cyclists_per_hour < 150:
-        recommendations += f"""
-**Flujo Medio** ({cyclists_per_hour:.0f} ciclistas/hora proyectados)
+""",
+    """
+**Flujo Medio** ({cph:.0f} ciclistas/hora proyectados)
 
 - ✅ Flujo suficiente para considerar ciclovía compartida
 - 🚦 Implementar señalización específica para ciclistas
 - 🛣️ Considerar carril compartido con buses (si aplica)
 - 📈 Monitorear crecimiento en próximos meses
-"""
-    else:
-        recommendations += f"""
-**Flujo Alto** ({cyclists_per_hour:.0f} ciclistas/hora proyectados)
+""",
+    """
+**Flujo Alto** ({cph:.0f} ciclistas/hora proyectados)
 
 - 🎯 **Prioridad Alta**: Implementar ciclovía segregada
 - 🚴‍♂️ Infraestructura justifica inversión en carril exclusivo
 - 🔒 Considerar estacionamientos seguros para bicicletas
 - 📊 Evaluar necesidad de semáforos específicos para ciclistas
-"""
+""",
+)
+
+# Recomendaciones por eje (0 = línea horizontal, 1 = línea vertical)
+_AXIS_DIRECTIONS = (("Arriba ↑", "Abajo ↓"), ("Izquierda ←", "Derecha →"))
+_AXIS_ARROWS = (("↑", "↓"), ("←", "→"))
+_AXIS_BALANCED = ("Arriba/Abajo", "Izquierda/Derecha")
+_AXIS_HEADERS = ("**Línea Horizontal:**\n", "\n**Línea Vertical:**\n")
+_RECOMMENDATION_AXES = {"horizontal": (0,), "vertical": (1,), "both": (0, 1)}
+
+_DOMINANT_TEMPLATE = "- 📊 Flujo predominante hacia **{direction}** ({percent:.0f}%)\n"
+_UNIDIRECTIONAL_TEMPLATE = "- 🎯 Considerar optimización unidireccional en horas pico\n"
+_BIDIRECTIONAL_TEMPLATE = (
+    "- ✅ Flujo bidireccional equilibrado ({balanced})\n"
+    "- 🎯 Diseño debe considerar tráfico en ambas direcciones\n"
+)
+_BALANCED_TEMPLATE = "- ✅ Flujo equilibrado ({arrow_a} {count_a} / {arrow_b} {count_b})\n"
+_INTERSECTION_TEMPLATE = (
+    "\n- 🎯 Intersección compleja: diseño debe considerar todas las direcciones\n"
+    "- 🚦 Priorizar señalización y semáforos especiales para ciclistas\n"
+)
 
-    # Análisis de dirección según orientación
-    recommendations += f"\n**Análisis de Direccionalidad:**\n\n"
 
-    if line_orientation == "horizontal":
-        up_ratio = metrics['cyclists_up'] / total if total > 0 else 0
-        down_ratio = metrics['cyclists_down'] / total if total > 0 else 0
+def generate_recommendations(metrics: Dict) -> str:
+    """
+    Genera recomendaciones basadas en métricas
 
-        if abs(up_ratio - down_ratio) > 0.3:
-            dominant_dir = "Arriba ↑" if up_ratio > down_ratio else "Abajo ↓"
-            recommendations += f"- 📊 Flujo predominante hacia **{dominant_dir}** ({max(up_ratio, down_ratio)*100:.0f}%)\n"
-            recommendations += f"- 🎯 Considerar optimización unidireccional en horas pico\n"
-        else:
-            recommendations += f"- ✅ Flujo bidireccional equilibrado (Arriba/Abajo)\n"
-            recommendations += f"- 🎯 Diseño debe considerar tráfico en ambas direcciones\n"
+    Args:
+        metrics: Diccionario con métricas
+
+    Returns:
+        String con recomendaciones en Markdown
+    """
+    if f'{DIRECTION_KEYS[0]}_ratio' not in metrics:
+        metrics = enrich_metrics(metrics)
+
+    return _recommendations(
+        metrics['cyclists_per_hour'],
+        tuple(metrics[key] for key in DIRECTION_KEYS),
+        tuple(metrics[f'{key}_ratio'] for key in DIRECTION_KEYS),
+        metrics.get('line_orientation', 'horizontal'),
+    )
+
+
+@st.cache_data(max_entries=64, show_spinner=False)
+def _recommendations(cyclists_per_hour: float, counts: Tuple[int, ...], ratios: Tuple[float, ...],
+                     line_orientation: str) -> str:
+    """
+    Construye el Markdown de recomendaciones; se memoiza por las métricas que usa
+
+    Args:
+        cyclists_per_hour: Flujo proyectado de ciclistas por hora
+        counts: Ciclistas (arriba, abajo, izquierda, derecha)
+        ratios: Proporción de cada sentido sobre el total, en el mismo orden
+        line_orientation: Orientación de la línea ('horizontal', 'vertical' o 'both')
 
-    elif line_orientation == "vertical":
-        left_ratio = metrics['cyclists_left'] / total if total > 0 else 0
-        right_ratio = metrics['cyclists_right'] / total if total > 0 else 0
+    Returns:
+        String con recomendaciones en Markdown
+    """
+    flow_level = bisect.bisect_right(_FLOW_THRESHOLDS, cyclists_per_hour)
+    parts = [
+        "### 💡 Recomendaciones para Planificación Urbana\n\n",
+        FLOW_TEMPLATES[flow_level].format(cph=cyclists_per_hour),
+        # Análisis de dirección según orientación
+        "\n**Análisis de Direccionalidad:**\n\n",
+    ]
 
-        if abs(left_ratio - right_ratio) > 0.3:
-            dominant_dir = "Izquierda ←" if left_ratio > right_ratio else "Derecha →"
-            recommendations += f"- 📊 Flujo predominante hacia **{dominant_dir}** ({max(left_ratio, right_ratio)*100:.0f}%)\n"
-            recommendations += f"- 🎯 Considerar optimización unidireccional en horas pico\n"
+    # Filas = ejes (horizontal, vertical), columnas = sentidos
+    ratios = np.asarray(ratios, dtype=np.float64).reshape(2, 2)
+    dominant = ratios.argmax(axis=1)
+    peak = ratios.max(axis=1)
+    unbalanced = np.abs(ratios[:, 0] - ratios[:, 1]) > 0.3
+
+    axes = _RECOMMENDATION_AXES.get(line_orientation, (0, 1))
+
+    if len(axes) == 1:
+        axis = axes[0]
+        if unbalanced[axis]:
+            parts.append(_DOMINANT_TEMPLATE.format(
+                direction=_AXIS_DIRECTIONS[axis][dominant[axis]], percent=peak[axis] * 100
+            ))
+            parts.append(_UNIDIRECTIONAL_TEMPLATE)
         else:
-            recommendations += f"- ✅ Flujo bidireccional equilibrado (Izquierda/Derecha)\n"
-            recommendations += f"- 🎯 Diseño debe considerar tráfico en ambas direcciones\n"
+            parts.append(_BIDIRECTIONAL_TEMPLATE.format(balanced=_AXIS_BALANCED[axis]))
 
     else:  # both
-        # Análisis para línea horizontal
-        up_ratio = metrics['cyclists_up'] / total if total > 0 else 0
-        down_ratio = metrics['cyclists_down'] / total if total > 0 else 0
-        # Análisis para línea vertical
-        left_ratio = metrics['cyclists_left'] / total if total > 0 else 0
-        right_ratio = metrics['cyclists_right'] / total if total > 0 else 0
-
-        total_h = metrics['cyclists_up'] + metrics['cyclists_down']
-        total_v = metrics['cyclists_left'] + metrics['cyclists_right']
-
-        recommendations += f"**Línea Horizontal:**\n"
-        if abs(up_ratio - down_ratio) > 0.3:
-            dominant_dir_h = "Arriba ↑" if up_ratio > down_ratio else "Abajo ↓"
-            recommendations += f"- 📊 Flujo predominante hacia **{dominant_dir_h}** ({max(up_ratio, down_ratio)*100:.0f}%)\n"
-        else:
-            recommendations += f"- ✅ Flujo equilibrado (↑ {metrics['cyclists_up']} / ↓ {metrics['cyclists_down']})\n"
+        for axis in axes:
+            parts.append(_AXIS_HEADERS[axis])
+            if unbalanced[axis]:
+                parts.append(_DOMINANT_TEMPLATE.format(
+                    direction=_AXIS_DIRECTIONS[axis][dominant[axis]], percent=peak[axis] * 100
+                ))
+            else:
+                arrow_a, arrow_b = _AXIS_ARROWS[axis]
+                parts.append(_BALANCED_TEMPLATE.format(
+                    arrow_a=arrow_a, count_a=counts[2 * axis], arrow_b=arrow_b, count_b=counts[2 * axis + 1]
+                ))
+        parts.append(_INTERSECTION_TEMPLATE)
+
+    return "".join(parts)
+
+
+def _detection_results_h(metrics: Dict) -> str:
+    """Resultados de detección para línea horizontal"""
+    return f"""
+**Resultados de Detección:**
+- Total detectado: {metrics['total_cyclists']}
+- Dirección arriba ↑: {metrics['cyclists_up']}
+- Dirección abajo ↓: {metrics['cyclists_down']}
+"""
 
-        recommendations += f"\n**Línea Vertical:**\n"
-        if abs(left_ratio - right_ratio) > 0.3:
-            dominant_dir_v = "Izquierda ←" if left_ratio > right_ratio else "Derecha →"
-            recommendations += f"- 📊 Flujo predominante hacia **{dominant_dir_v}** ({max(left_ratio, right_ratio)*100:.0f}%)\n"
-        else:
-            recommendations += f"- ✅ Flujo equilibrado (← {metrics['cyclists_left']} / → {metrics['cyclists_right']})\n"
 
-        recommendations += f"\n- 🎯 Intersección compleja: diseño debe considerar todas las direcciones\n"
-        recommendations += f"- 🚦 Priorizar señalización y semáforos especiales para ciclistas\n"
+def _detection_results_v(metrics: Dict) -> str:
+    """Resultados de detección para línea vertical"""
+    return f"""
+**Resultados de Detección:**
+- Total detectado: {metrics['total_cyclists']}
+- Dirección izquierda ←: {metrics['cyclists_left']}
+- Dirección derecha →: {metrics['cyclists_right']}
+"""
+
+
+def _detection_results_both(metrics: Dict) -> str:
+    """Resultados de detección para ambas líneas"""
+    return f"""
+**Resultados de Detección:**
+- Total detectado: {metrics['total_cyclists']}
+- Horizontal - Arriba ↑: {metrics['cyclists_up']}
+- Horizontal - Abajo ↓: {metrics['cyclists_down']}
+- Vertical - Izquierda ←: {metrics['cyclists_left']}
+- Vertical - Derecha →: {metrics['cyclists_right']}
+"""
+
 
-    return recommendations
+_DETECTION_RESULTS = {
+    "horizontal": _detection_results_h,
+    "vertical": _detection_results_v,
+    "both": _detection_results_both,
+}
 
 
 def display_technical_details(metrics: Dict) -> None:
@@ -425,6 +485,8 @@ def display_technical_details(metrics: Dict) -> None:
             st.markdown(f"""
 **Parámetros del Modelo:**
 - Modelo: {metrics['model_used']}
+- Backend: {metrics.get('backend', 'torch')}
+- Precisión: {metrics.get('precision', 'fp32').upper()}
 - Confianza: {metrics['confidence_threshold']}
 - Tracking: BoT-SORT
 - Orientación línea: {line_orientation}
@@ -434,33 +496,14 @@ def display_technical_details(metrics: Dict) -> None:
 - FPS: {metrics['fps']}
 - Frames totales: {metrics['total_frames']}
 - Frames procesados: {metrics['processed_frames']}
+- Frames en video de salida: {metrics.get('output_frames', metrics['total_frames'])}
+- FPS del video de salida: {metrics.get('output_fps', metrics['fps'])}
+- Codificación: {metrics.get('encoder', 'OpenCV + libx264')}
             """)
 
         with col2:
             # Generar resultados de detección según orientación
-            if line_orientation == "horizontal":
-                detection_results = f"""
-**Resultados de Detección:**
-- Total detectado: {metrics['total_cyclists']}
-- Dirección arriba ↑: {metrics['cyclists_up']}
-- Dirección abajo ↓: {metrics['cyclists_down']}
-"""
-            elif line_orientation == "vertical":
-                detection_results = f"""
-**Resultados de Detección:**
-- Total detectado: {metrics['total_cyclists']}
-- Dirección izquierda ←: {metrics['cyclists_left']}
-- Dirección derecha →: {metrics['cyclists_right']}
-"""
-            else:  # both
-                detection_results = f"""
-**Resultados de Detección:**
-- Total detectado: {metrics['total_cyclists']}
-- Horizontal - Arriba ↑: {metrics['cyclists_up']}
-- Horizontal - Abajo ↓: {metrics['cyclists_down']}
-- Vertical - Izquierda ←: {metrics['cyclists_left']}
-- Vertical - Derecha →: {metrics['cyclists_right']}
-"""
+            detection_results = _DETECTION_RESULTS.get(line_orientation, _detection_results_both)(metrics)
 
             st.markdown(detection_results + f"""
 **Métricas de Flujo:**
@@ -469,80 +512,66 @@ def display_technical_details(metrics: Dict) -> None:
             """)
 
 
-def create_summary_dataframe(metrics: Dict) -> pd.DataFrame:
+# Filas del resumen exportable según orientación de línea: (nombre, valor a partir de metrics)
+_SUMMARY_TOTAL = [
+    ('Total Ciclistas', itemgetter('total_cyclists')),
+]
+_SUMMARY_COMMON = [
+    ('Ciclistas por Minuto', lambda m: f"{m['cyclists_per_minute']:.2f}"),
+    ('Ciclistas por Hora (Proyección)', lambda m: f"{m['cyclists_per_hour']:.2f}"),
+    ('Duración Video (min)', lambda m: f"{m['duration_minutes']:.2f}"),
+    ('Orientación Línea', lambda m: m.get('line_orientation', 'horizontal')),
+    ('Modelo Utilizado', itemgetter('model_used')),
+    ('Confianza Mínima', itemgetter('confidence_threshold')),
+]
+_SUMMARY_ROWS: Dict[str, List[Tuple[str, Callable[[Dict], object]]]] = {
+    "horizontal": _SUMMARY_TOTAL + [
+        ('Ciclistas hacia Arriba', itemgetter('cyclists_up')),
+        ('Ciclistas hacia Abajo', itemgetter('cyclists_down')),
+    ] + _SUMMARY_COMMON,
+    "vertical": _SUMMARY_TOTAL + [
+        ('Ciclistas hacia Izquierda', itemgetter('cyclists_left')),
+        ('Ciclistas hacia Derecha', itemgetter('cyclists_right')),
+    ] + _SUMMARY_COMMON,
+    "both": _SUMMARY_TOTAL + [
+        ('Ciclistas hacia Arriba (Horizontal)', itemgetter('cyclists_up')),
+        ('Ciclistas hacia Abajo (Horizontal)', itemgetter('cyclists_down')),
+        ('Ciclistas hacia Izquierda (Vertical)', itemgetter('cyclists_left')),
+        ('Ciclistas hacia Derecha (Vertical)', itemgetter('cyclists_right')),
+    ] + _SUMMARY_COMMON,
+}
+
+
+def _summary_rows(metrics: Dict) -> List[Tuple[str, object]]:
     """
-    Crea DataFrame resumen para exportar
+    Genera las filas (métrica, valor) del resumen exportable
 
     Args:
         metrics: Diccionario con métricas
 
     Returns:
-        DataFrame con resumen
+        Lista de tuplas (nombre de métrica, valor)
     """
     line_orientation = metrics.get('line_orientation', 'horizontal')
+    rows = _SUMMARY_ROWS.get(line_orientation, _SUMMARY_ROWS["both"])
+    return [(name, value(metrics)) for name, value in rows]
 
-    # Métricas base
-    metric_names = [
-        'Total Ciclistas',
-    ]
-    values = [
-        metrics['total_cyclists'],
-    ]
 
-    # Añadir métricas según orientación
-    if line_orientation == "horizontal":
-        metric_names.extend([
-            'Ciclistas hacia Arriba',
-            'Ciclistas hacia Abajo',
-        ])
-        values.extend([
-            metrics['cyclists_up'],
-            metrics['cyclists_down'],
-        ])
-    elif line_orientation == "vertical":
-        metric_names.extend([
-            'Ciclistas hacia Izquierda',
-            'Ciclistas hacia Derecha',
-        ])
-        values.extend([
-            metrics['cyclists_left'],
-            metrics['cyclists_right'],
-        ])
-    else:  # both
-        metric_names.extend([
-            'Ciclistas hacia Arriba (Horizontal)',
-            'Ciclistas hacia Abajo (Horizontal)',
-            'Ciclistas hacia Izquierda (Vertical)',
-            'Ciclistas hacia Derecha (Vertical)',
-        ])
-        values.extend([
-            metrics['cyclists_up'],
-            metrics['cyclists_down'],
-            metrics['cyclists_left'],
-            metrics['cyclists_right'],
-        ])
-
-    # Métricas comunes finales
-    metric_names.extend([
-        'Ciclistas por Minuto',
-        'Ciclistas por Hora (Proyección)',
-        'Duración Video (min)',
-        'Orientación Línea',
-        'Modelo Utilizado',
-        'Confianza Mínima'
-    ])
-    values.extend([
-        f"{metrics['cyclists_per_minute']:.2f}",
-        f"{metrics['cyclists_per_hour']:.2f}",
-        f"{metrics['duration_minutes']:.2f}",
-        line_orientation,
-        metrics['model_used'],
-        metrics['confidence_threshold']
-    ])
+def create_summary_csv(metrics: Dict) -> str:
+    """
+    Crea el CSV resumen para exportar
 
-    data = {
-        'Métrica': metric_names,
-        'Valor': values
-    }
+    El resumen tiene una docena de filas, así que se escribe con csv.writer
+    directamente en lugar de construir un DataFrame de pandas.
 
-    return pd.DataFrame(data)
+    Args:
+        metrics: Diccionario con métricas
+
+    Returns:
+        Contenido CSV como string (mismo formato que DataFrame.to_csv(index=False))
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+    writer.writerow(['Métrica', 'Valor'])
+    writer.writerows(_summary_rows(metrics))
+    return buffer.getvalue()